@@ -0,0 +1,60 @@
+# bench_mccp.py
+
+# What MCCP2 output compression buys, and what it costs: compression ratio and CPU time per KB of
+# REPL output, for a few kinds of output, when it's flushed in coalesced 512-byte chunks (what
+# write() sends) and line by line (what typing and echo look like).  Uses telnetd's own _Deflate,
+# so under CPython this is zlib.  Stock micropython builds can't compress for MCCP (see
+# _Deflate.available()), so there it only says so; a build whose DeflateIO can flush gives its
+# own numbers.
+#
+#   python3 bench/bench_mccp.py [repeats]
+
+import sys
+import time
+
+import mpshim
+
+WORKLOADS = {
+    'traceback': ''.join('Traceback (most recent call last):\n  File "<stdin>", line {}, in <module>\n  File "lib/sensors.py", line 88, in read\nOSError: [Errno 110] ETIMEDOUT\n'.format(i) for i in range(40)),
+    'dir()': repr(['__class__', '__name__', 'append', 'clear', 'copy', 'count', 'extend', 'index', 'insert', 'pop', 'remove', 'reverse', 'sort'] * 12) + '\n',
+    'logging': ''.join('2024-08-03 12:{:02d}:{:02d} INFO sensor temp={}.{} hum={} rssi=-{}\n'.format(i // 60, i % 60, 20 + i % 7, i % 10, 40 + i % 13, 60 + i % 20) for i in range(60)),
+    'hexdump': ''.join('{:08x}: {}\n'.format(i * 16, ' '.join('{:02x}'.format((i * 131 + j * 71) % 256) for j in range(16))) for i in range(60)),
+}
+
+
+def chunks(data, how):
+    if how == 'lines':
+        return [l + b'\n' for l in data.split(b'\n') if l]
+    return [data[i:i + 512] for i in range(0, len(data), 512)]
+
+
+def run(telnetd, data, how, wbits, repeats):
+    parts = chunks(data, how)
+    out = 0
+    t0 = time.ticks_us()
+    for _ in range(repeats):
+        z = telnetd._Deflate(wbits)
+        for p in parts:
+            out += len(z.compress(p))
+    us = time.ticks_diff(time.ticks_us(), t0)
+    raw = len(data) * repeats
+    return raw / out, us / (raw / 1024)
+
+
+def main(repeats=20):
+    telnetd = mpshim.load_telnetd()
+    print('telnetd {}  ({})'.format(telnetd.__version__, sys.implementation.name))
+    if not telnetd._Deflate.available():
+        print('this build has no flushable compressor, so telnetd never offers MCCP here; nothing to measure')
+        return 1
+    print('{:10s} {:6s} {:>5s} {:>7s} {:>10s}'.format('output', 'flush', 'wbits', 'ratio', 'us/KB'))
+    for name, text in WORKLOADS.items():
+        data = text.encode()
+        for how in ('512', 'lines'):
+            for wbits in (9, 10, 12):
+                ratio, cost = run(telnetd, data, how, wbits, repeats)
+                print('{:10s} {:6s} {:5d} {:7.2f} {:10.1f}'.format(name, how, wbits, ratio, cost))
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(a) for a in sys.argv[1:]]))
@@ -0,0 +1,40 @@
+# bench_poll.py
+
+# Per-tick cost of telnetd's socket polling as the number of connected clients grows.
+# A "tick" is one read_input() call (what every dupterm readinto() does) and one write()
+# of a short line (what every REPL output chunk does).  With the poll registry the read tick
+# stays flat from 1 to 16 clients, and a write costs one send() per client with no select().
+#
+#   python3 bench/bench_poll.py [iterations]
+
+import sys
+
+from benchlib import server, connect, drain, timeit
+
+
+def main(n=2000):
+    telnetd, t, port = server()
+    t.max_sessions = 16 # (default 8)
+
+    clients = []
+    line = b'x' * 30 + b'\n'
+    print('clients  read_input us/tick  write us/tick')
+    for want in (1, 2, 4, 8, 16):
+        while len(clients) < want:
+            clients.append(connect(t, port))
+        r = timeit(t.read_input, n) * 1e6
+        w = 0
+        for _ in range(4): # write in slices so the client sockets never fill up
+            w += timeit(lambda: t.write(line), n // 4) * 1e6
+            t.flush()
+            for c in clients:
+                drain(c)
+        print('{:7d}  {:18.2f}  {:13.2f}'.format(want, r, w / 4))
+
+    for c in clients:
+        c.close()
+    t.read_input()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,178 @@
+# bench_telnetd.py
+
+# Micro-benchmarks for telnetd's hot paths, run off-device under CPython with the stand-ins
+# in mpshim.py and socketpair-backed clients.  Compare the numbers across releases before
+# rolling a new telnetd out.
+#
+#   python3 bench/bench_telnetd.py [--quick] [--json results.json]
+#
+# idle       readinto() and write() of the line with nobody connected (dupterm's cost to the board when telnet isn't in use)
+# fanout     send_chars_to_all() of one 80-byte line to N logged-in clients
+# write      write() of the same line (what dupterm calls), including coalescing
+# poll       read_input() with N idle clients
+# input      a 64-byte chunk from one of N clients, through read_input() and readinto()
+# keystroke  _process_input() of one printable character at a time, as typed (the line editor)
+# edit       _process_input() of a 64-byte pasted chunk with a few cursor keys in it, as one recv()
+# chkpass    _chkpass() of a password against the stored hash
+# upload     a 64 KB file through the binary transfer option (tools/tnput.py's protocol)
+
+import os
+import sys
+import json
+import zlib
+import struct
+import tempfile
+
+from benchlib import server, fake_client, drain, timeit, Quiet, PASSWORD, PWHASH
+
+CLIENTS = (0, 1, 2, 4, 8, 16, 32)
+LINE = b'Traceback (most recent call last):  File "<stdin>", line 1, in <module>  x\n' # 80 bytes
+
+
+def bench_idle(t, clients, n):
+    b = bytearray(256)
+
+    def run():
+        t.readinto(b)
+        t.write(LINE)
+    s = timeit(run, n)
+    return 1 / s, len(LINE) / s
+
+
+def bench_fanout(t, clients, n):
+    def run():
+        for _ in range(16):
+            t.send_chars_to_all(LINE)
+        for c in clients:
+            drain(c)
+    s = timeit(run, n // 16) / 16
+    return 1 / s, len(LINE) * len(clients) / s
+
+
+def bench_write(t, clients, n):
+    def run():
+        for _ in range(16):
+            t.write(LINE)
+        t.flush()
+        for c in clients:
+            drain(c)
+    s = timeit(run, n // 16) / 16
+    return 1 / s, len(LINE) * len(clients) / s
+
+
+def bench_poll(t, clients, n):
+    s = timeit(t.read_input, n)
+    return 1 / s, 0
+
+
+def bench_input(t, clients, n):
+    chunk = b'for i in range(10): print(i)  # pasted into the REPL over telnet.....\r'[:64]
+    b = bytearray(256)
+    c = clients[-1]
+
+    def run():
+        c.send(chunk)
+        got = 0
+        while got < len(chunk):
+            r = t.readinto(b)
+            if r:
+                got += r
+    s = timeit(run, n)
+    return 1 / s, len(chunk) / s
+
+
+def bench_keystroke(t, clients, n):
+    with Quiet():
+        def run():
+            for ch in 'print(1234) ':
+                t._process_input(ch)
+            t._process_input('\r')
+        s = timeit(run, n // 13) / 13
+    return 1 / s, 1 / s
+
+
+def bench_edit(t, clients, n):
+    chunk = b'for i in range(10):\x1b[D\x1b[D\x1b[C print(i, end=" ")  # pasted.......\r'[:64]
+    with Quiet():
+        def run():
+            r = t._process_input(chunk)
+            while r:
+                r = t._process_input(b'')
+        s = timeit(run, n)
+    return 1 / s, len(chunk) / s
+
+
+def bench_chkpass(t, clients, n):
+    s = timeit(lambda: t._chkpass('chk', PASSWORD, PWHASH), max(n // 10, 10))
+    return 1 / s, 0
+
+
+def bench_upload(t, clients, n):
+    data = os.urandom(65536)
+    path = os.path.join(tempfile.mkdtemp(), 'up.bin').encode()
+    put = struct.pack('>BBBBIII', 255, 250, 201, 2, 0, len(data), zlib.crc32(data)) # IAC SB XFER PUT offset size crc32
+    put = put[:4] + put[4:].replace(b'\xff', b'\xff\xff') + path + b'\xff\xf0'
+    c = clients[0]
+    c.send(b'\xff\xfb\xc9') # IAC WILL XFER
+    t.read_input()
+    drain(c)
+
+    def run():
+        c.send(put)
+        t.read_input()
+        mv = memoryview(data)
+        while mv:
+            try:
+                mv = mv[c.send(mv):]
+            except BlockingIOError:
+                pass
+            t.read_input()
+        while t.sockets[0].xf:
+            t.read_input()
+        drain(c)
+    s = timeit(run, max(n // 100, 2))
+    return 1 / s, len(data) / s
+
+
+BENCHES = (
+    ('idle', bench_idle),
+    ('fanout', bench_fanout),
+    ('write', bench_write),
+    ('poll', bench_poll),
+    ('input', bench_input),
+    ('keystroke', bench_keystroke),
+    ('edit', bench_edit),
+    ('chkpass', bench_chkpass),
+    ('upload', bench_upload),
+)
+
+
+def main(argv):
+    n = 400 if '--quick' in argv else 4000
+    out = argv[argv.index('--json') + 1] if '--json' in argv else None
+    telnetd, t, port = server()
+    clients = []
+    results = []
+    print('telnetd {}  ({} iterations)'.format(telnetd.__version__, n))
+    print('{:10s} {:>7s} {:>12s} {:>14s}'.format('bench', 'clients', 'ops/s', 'bytes/s'))
+    for want in CLIENTS:
+        while len(clients) < want:
+            clients.append(fake_client(t))
+        for name, fn in BENCHES:
+            if (name == 'idle') != (want == 0):
+                continue # idle is the only one without clients
+            if name in ('keystroke', 'edit', 'chkpass', 'upload') and want != 1:
+                continue # don't depend on the client count
+            ops, bps = fn(t, clients, n)
+            results.append({'bench': name, 'clients': want, 'ops': ops, 'bytes': bps})
+            print('{:10s} {:7d} {:12.0f} {:14.0f}'.format(name, want, ops, bps))
+    for c in clients:
+        c.close()
+    t.read_input()
+    if out:
+        with open(out, 'w') as f:
+            json.dump({'version': telnetd.__version__, 'iterations': n, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
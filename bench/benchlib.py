@@ -0,0 +1,98 @@
+# benchlib.py
+
+# Helpers shared by the benchmarks: clients (real TCP ones that go through the handshake, or
+# socketpair-backed ones that skip it), draining, and timing.
+
+import sys
+import time
+import socket
+import select
+
+import mpshim
+
+PASSWORD = 'pass'
+PWHASH = "$5$bl0zjwUtt8T2WLJBH5Vadl/Ix6X+cFdJr5td4a0B+n0=$1txXuyLLzAvAMM/jYSlpRScy3nSwvTQ05Mv7At5LiSs=$" # 'pass', as in start()
+
+
+def server(**kw):
+    """A telnetd listening on an ephemeral localhost port.  Returns (module, instance, port)."""
+    telnetd = mpshim.load_telnetd()
+    t = telnetd.telnetd()
+    t.telnetd(PWHASH, port=0, ip='127.0.0.1', **kw)
+    return telnetd, t, t.server_socket.getsockname()[1]
+
+
+def drain(c):
+    """Read whatever is waiting on a non-blocking client socket."""
+    got = b''
+    while True:
+        try:
+            d = c.recv(65536)
+        except BlockingIOError:
+            return got
+        if not d:
+            return got
+        got += d
+
+
+def connect(t, port, timeout=10):
+    """Open a real TCP client, walk it through the handshake and password prompt."""
+    c = socket.create_connection(('127.0.0.1', port))
+    c.sendall(b'\xff\xfc\x01') # IAC WONT ECHO - any reply will do
+    c.setblocking(False)
+    got = b''
+    deadline = time.time() + timeout
+    while b'Password: ' not in got:
+        if time.time() > deadline:
+            raise RuntimeError('handshake timed out; got {!r}'.format(got))
+        t.read_input()
+        got += drain(c)
+    c.sendall(b'\xff\xfc\x01' + PASSWORD.encode() + b'\r') # answer the prompt round like a real client would, then type the password
+    while b'>>> ' not in got:
+        if time.time() > deadline:
+            raise RuntimeError('login timed out; got {!r}'.format(got))
+        t.read_input()
+        t.flush()
+        got += drain(c)
+    return c
+
+
+def fake_client(t):
+    """A socketpair-backed client, logged in through telnetd's own input path.  Returns the client end."""
+    s, c = mpshim.socketpair()
+    s.setblocking(False)
+    t._poll.register(s, select.POLLIN)
+    ent = t._add_client(s, ('socketpair', len(t.sockets)))
+    pw = PASSWORD.encode() + b'\r'
+    b = t._pool[0]
+    b[:len(pw)] = pw
+    t._client_data(ent, b, len(pw))
+    t.flush()
+    c.setblocking(False)
+    drain(c)
+    return c
+
+
+class Quiet:
+    """Swallow stdout (the line editor print()s its redraws)."""
+    def __enter__(self):
+        self.out = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, *a):
+        sys.stdout = self.out
+
+    def write(self, s):
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+def timeit(fn, n):
+    """Seconds per call of fn(), over n calls."""
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n
@@ -0,0 +1,63 @@
+# footprint.py
+
+# Boot-time and heap cost of telnetd: how long `import telnetd` takes and how much heap it keeps,
+# then the same for creating the server object, listening, and loading the line editor.  On a
+# board it measures whatever `import telnetd` finds, so to measure the .mpy build copy the
+# telnetd124.mpy that make builds there as telnetd.mpy (with telnetd_edit.mpy), and stop any
+# running telnetd first:
+#
+#   mpremote run bench/footprint.py      # on a board (network up; listens on port 2323)
+#   micropython bench/footprint.py       # unix port
+#   python3 bench/footprint.py           # CPython: heap is tracemalloc's, so only relative
+#
+# The heap number is what's still allocated after a gc.collect(), i.e. what the step costs for as
+# long as telnetd is loaded.
+
+import gc
+import sys
+import time
+
+try:
+    import network # a board: the real modules are all there
+except ImportError:
+    sys.path.insert(0, __file__.rpartition('/')[0] or '.')
+    import mpshim
+    mpshim.install()
+    if sys.implementation.name != 'micropython':
+        import tracemalloc
+        tracemalloc.start()
+
+
+def used():
+    gc.collect()
+    if hasattr(gc, 'mem_alloc'):
+        return gc.mem_alloc()
+    import tracemalloc
+    return tracemalloc.get_traced_memory()[0]
+
+
+def step(name, fn):
+    m0 = used()
+    t0 = time.ticks_us()
+    r = fn()
+    us = time.ticks_diff(time.ticks_us(), t0)
+    print('{:22s} {:9.2f} {:9d}'.format(name, us / 1000, used() - m0))
+    return r
+
+
+def main():
+    print('{:22s} {:>9s} {:>9s}'.format('step', 'ms', 'heap'))
+    if 'mpshim' in sys.modules:
+        telnetd = step('import telnetd', sys.modules['mpshim'].load_telnetd)
+    else:
+        telnetd = step('import telnetd', lambda: __import__('telnetd'))
+    t = step('telnetd()', telnetd.telnetd)
+    pw = t._chkpass('create', 'pass')
+    step('listen (poll mode)', lambda: t.telnetd(pw, port=2323, ip='127.0.0.1' if 'mpshim' in sys.modules else '0.0.0.0'))
+    step('line editor', t._editor)
+    if hasattr(gc, 'mem_free'):
+        print('mem_free now', gc.mem_free())
+    t.server_socket.close()
+
+
+main()
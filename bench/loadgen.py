@@ -0,0 +1,268 @@
+# loadgen.py
+
+# End-to-end load test: a telnetd (under CPython with mpshim's stand-ins, or the unix port) with a stand-in REPL
+# that echoes what's typed, and N real TCP clients that go through the whole IAC handshake and password prompt.
+# Each workload runs for a few seconds at each client count:
+#
+# echo   every client types a short unique token 10 times a second; echo latency is until it sees it come back
+# bulk   the REPL prints as fast as it can (or --rate bytes/s) while client 0 keeps typing: is it still usable?
+# paste  every client pastes 2 KB at once, over and over; the REPL reads it all and echoes it
+# churn  all but client 0 keep disconnecting and reconnecting; handshake time, and client 0's echo meanwhile
+#
+#   python3 bench/loadgen.py [--clients 1,4,16] [--seconds 3] [--workloads echo,bulk,paste,churn] [--rate bytes/s] [--line] [--json out.json]
+#
+# --line runs telnetd in line mode (telnetd.line_mode): typing is echoed by the session's own line editor, and the REPL only
+# sees whole lines.
+#
+# out kB/s is what the clients received in total; dropped is what telnetd's output buffers threw away (a slow
+# client's oldest lines); lost is typed tokens whose echo never arrived.
+
+import sys
+import json
+import time
+import socket
+import itertools
+
+from benchlib import server, PASSWORD
+import mpshim
+
+LINE = b'%08d Traceback (most recent call last):  File "main.py", line 12, in <module>\n'
+
+
+def now():
+    return time.perf_counter()
+
+
+def pct(v, p):
+    if not v:
+        return 0
+    v = sorted(v)
+    return v[min(len(v) - 1, int(len(v) * p / 100))]
+
+
+class Repl:
+    """Stands in for micropython's REPL on top of telnetd: reads what dupterm would, echoes it, a new prompt on Enter."""
+    def __init__(self, t):
+        self.t = t
+        self.b = bytearray(256)
+        self.got = 0
+        self.sent = 0
+        self.t0 = now()
+
+    def pump(self):
+        mpshim.run_callbacks() # new connections (telnetd doesn't poll for them while nobody's connected)
+        while True:
+            n = self.t.readinto(self.b)
+            if not n:
+                break
+            self.got += n
+            self.t.write(bytes(self.b[:n]).replace(b'\r', b'\r\n>>> '))
+
+    def spew(self, rate):
+        if rate: # keep to rate bytes/s
+            while self.sent < (now() - self.t0) * rate:
+                self.t.write(LINE % self.sent)
+                self.sent += len(LINE)
+        else:
+            for _ in range(8):
+                self.t.write(LINE % self.sent)
+                self.sent += len(LINE)
+
+
+class Client:
+    """One telnet client, non-blocking: answers option negotiation (refusing everything), logs in, then types and watches for its echo."""
+    def __init__(self, port, i):
+        self.i = i
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # as telnet clients do; otherwise Nagle's algorithm shows up as echo latency
+        self.s.setblocking(False)
+        self.s.connect_ex(('127.0.0.1', port))
+        self.t0 = now()
+        self.state = 'neg' # -> 'pw' -> 'repl', or 'gone'
+        self.hs = None     # handshake time, s
+        self.text = b''    # recent plain text received
+        self.rx = 0
+        self.iac = b''     # telnet command being collected
+        self.pend = []     # (token, when typed)
+        self.lat = []
+        self.lost = 0
+        self.seq = 0
+        self.out = b''     # waiting to be sent
+
+    def _telnet(self, data): # strip telnet commands, answering DO/WILL with WONT/DONT
+        plain = bytearray()
+        for c in data:
+            if self.iac:
+                self.iac += bytes((c,))
+                if self.iac[1] in (251, 252, 253, 254) and len(self.iac) == 3:
+                    if self.iac[1] in (251, 253):
+                        self.out += bytes((255, 254 if self.iac[1] == 251 else 252, c))
+                    self.iac = b''
+                elif self.iac[1] == 250:
+                    if self.iac[-2:] == b'\xff\xf0':
+                        self.iac = b''
+                elif self.iac[1] not in (250, 251, 252, 253, 254):
+                    if self.iac[1] == 255:
+                        plain.append(255)
+                    self.iac = b''
+            elif c == 255:
+                self.iac = b'\xff'
+            else:
+                plain.append(c)
+        return bytes(plain)
+
+    def step(self):
+        if self.state == 'gone':
+            return
+        while True:
+            try:
+                d = self.s.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                d = b''
+            if not d:
+                self.close()
+                return
+            self.rx += len(d)
+            new = self._telnet(d) if (self.iac or b'\xff' in d) else d
+            window = self.text[-16:] + new # where a token could have just completed
+            self.text = (self.text + new)[-8192:]
+            if self.state == 'neg' and b'Password: ' in self.text:
+                self.out += PASSWORD.encode() + b'\r\0'
+                self.state = 'pw'
+                self.text = b''
+            elif self.state == 'pw' and b'>>> ' in self.text:
+                self.state = 'repl'
+                self.hs = now() - self.t0
+            if self.pend:
+                t = now()
+                keep = []
+                for tok, t1 in self.pend:
+                    if tok in window:
+                        self.lat.append(t - t1)
+                    elif t - t1 > 5:
+                        self.lost += 1
+                    else:
+                        keep.append((tok, t1))
+                self.pend = keep
+        if self.out:
+            try:
+                self.out = self.out[self.s.send(self.out):]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.close()
+
+    def type(self, enter=False):
+        tok = b'k%d_%d' % (self.i, self.seq)
+        self.seq += 1
+        self.pend.append((tok, now()))
+        self.out += tok + (b'\r' if enter else b'')
+
+    def close(self):
+        if self.state != 'gone':
+            self.s.close()
+            self.state = 'gone'
+
+
+def run(t, repl, port, workload, n, seconds, rate):
+    ids = itertools.count()
+
+    def unauth():
+        return sum(c.state in ('neg', 'pw') for c in clients)
+
+    clients = []
+    while sum(c.state == 'repl' for c in clients) < n: # log in, only a few at a time (telnetd turns away more than max_unauth)
+        if unauth() < t.max_unauth and len(clients) < n:
+            clients.append(Client(port, next(ids)))
+        repl.pump()
+        for c in clients:
+            c.step()
+        clients = [c for c in clients if c.state != 'gone']
+    hs = [c.hs for c in clients]
+    drop0 = sum(x['drop'] for x in t.stats()['clients'])
+    stalls0 = t.stats()['stalls']
+    rx = -sum(c.rx for c in clients)
+    got0 = repl.got
+    paste = (b'x = [1' + b', 0' * 700)[:2047] + b'\r'
+    lat, lost, churned = [], 0, []
+    end = now() + seconds
+    next_key = now()
+    while now() < end:
+        repl.pump()
+        if workload == 'bulk':
+            repl.spew(rate)
+        for c in clients:
+            c.step()
+        if now() >= next_key:
+            next_key += 0.1
+            for c in (clients if workload in ('echo', 'paste') else clients[:1]):
+                if c.state == 'repl':
+                    if workload == 'paste' and not c.out:
+                        c.out += paste
+                    c.type(enter=c.seq % 10 == 9)
+        if workload == 'churn':
+            for k in range(1, len(clients)):
+                c = clients[k]
+                if c.state == 'repl' and now() - c.t0 > c.hs + 0.2: # logged in for a moment: go, and come back
+                    churned.append(c.hs)
+                elif c.state != 'gone' or unauth() >= t.max_unauth: # (gone: refused, so try again when there's room)
+                    continue
+                c.close()
+                rx += c.rx
+                clients[k] = Client(port, next(ids))
+    for c in clients:
+        c.step()
+    st = t.stats()
+    for c in clients:
+        lat += c.lat
+        lost += c.lost + sum(now() - t1 > 1 for tok, t1 in c.pend) # (younger ones are still on their way)
+        rx += c.rx
+        c.close()
+    t.read_input()
+    hs = churned or hs
+    return {
+        'workload': workload,
+        'clients': n,
+        'handshake_p50_ms': pct(hs, 50) * 1000,
+        'handshake_p99_ms': pct(hs, 99) * 1000,
+        'echo_p50_ms': pct(lat, 50) * 1000,
+        'echo_p99_ms': pct(lat, 99) * 1000,
+        'out_kBps': rx / seconds / 1024,
+        'in_kBps': (repl.got - got0) / seconds / 1024,
+        'dropped': sum(x['drop'] for x in st['clients']) - drop0, # (not counting clients that churned away)
+        'lost': lost,
+        'stalls': st['stalls'] - stalls0,
+    }
+
+
+def main(argv):
+    def opt(name, default):
+        return argv[argv.index(name) + 1] if name in argv else default
+    counts = [int(x) for x in opt('--clients', '1,4,16').split(',')]
+    seconds = float(opt('--seconds', '3'))
+    workloads = opt('--workloads', 'echo,bulk,paste,churn').split(',')
+    rate = int(opt('--rate', '0'))
+    out = opt('--json', None)
+    telnetd, t, port = server()
+    t.line_mode = '--line' in argv
+    t.max_sessions = max(counts) + 2
+    t.max_unauth = 4
+    repl = Repl(t)
+    print('telnetd {}  ({}, {}s per run{})'.format(telnetd.__version__, sys.implementation.name, seconds, ', line mode' if t.line_mode else ''))
+    cols = ('workload', 'clients', 'hs p50', 'hs p99', 'echo p50', 'echo p99', 'out kB/s', 'in kB/s', 'dropped', 'lost', 'stalls')
+    print(('{:8s} {:>7s}' + ' {:>9s}' * 9).format(*cols))
+    results = []
+    for w in workloads:
+        for n in counts:
+            r = run(t, repl, port, w, n, seconds, rate)
+            results.append(r)
+            print('{workload:8s} {clients:7d} {handshake_p50_ms:9.1f} {handshake_p99_ms:9.1f} {echo_p50_ms:9.2f} {echo_p99_ms:9.2f} {out_kBps:9.0f} {in_kBps:9.1f} {dropped:9d} {lost:9d} {stalls:9d}'.format(**r))
+    if out:
+        with open(out, 'w') as f:
+            json.dump({'version': telnetd.__version__, 'seconds': seconds, 'line_mode': t.line_mode, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
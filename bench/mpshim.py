@@ -0,0 +1,228 @@
+# mpshim.py
+
+# Stand-ins for the micropython-only modules telnetd.py uses, so its hot paths can be timed
+# under CPython (or the unix port, which only needs the ones it lacks).  Call install() before
+# importing telnetd; load_telnetd() does both.
+
+import sys
+import os
+import time
+import types
+import builtins
+import hashlib
+import weakref
+import socket as _socket
+import select as _select
+
+_is_mpy = sys.implementation.name == 'micropython'
+
+
+def _mod(_name, **kw):
+    m = types.ModuleType(_name)
+    m.__dict__.update(kw)
+    return m
+
+
+# --- time: micropython tick functions -------------------------------------------------
+
+def _ticks_ms():
+    return time.monotonic_ns() // 1000000
+
+def _ticks_us():
+    return time.monotonic_ns() // 1000
+
+def _ticks_diff(a, b):
+    return a - b
+
+def _ticks_add(a, b):
+    return a + b
+
+
+# --- machine / network / uos / uio ------------------------------------------------------
+
+class _WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.fed = 0
+
+    def feed(self):
+        self.fed += 1
+
+
+class _WLAN:
+    def __init__(self, i):
+        self.i = i
+
+    def active(self, *a):
+        return False
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+    def config(self, k):
+        return 'bench'
+
+
+class _uname:
+    sysname = 'shim'
+    version = sys.version.split()[0]
+    machine = sys.platform
+    release = version
+    nodename = 'bench'
+
+
+dupterm_obj = []  # whatever telnetd hands to uos.dupterm()
+
+
+def _dupterm(obj, idx=0):
+    prev = dupterm_obj[0] if dupterm_obj else None
+    dupterm_obj[:] = [obj] if obj is not None else []
+    return prev
+
+
+def _dupterm_notify(arg):
+    pass
+
+
+class _IOBase:
+    pass
+
+
+# --- micropython.schedule(): queued, run by run_scheduled() -----------------------------
+
+scheduled = []
+
+
+def _schedule(fn, arg):
+    if len(scheduled) >= 8:
+        raise RuntimeError('schedule queue full')
+    scheduled.append((fn, arg))
+
+
+def run_scheduled():
+    n = 0
+    while scheduled:
+        fn, arg = scheduled.pop(0)
+        fn(arg)
+        n += 1
+    return n
+
+
+# --- select: micropython poll() hands back the registered objects, and has ipoll() -----
+
+class _Poll:
+    def __init__(self):
+        self._p = _select.poll()
+        self._objs = {}
+
+    def register(self, obj, mask=_select.POLLIN | _select.POLLOUT):
+        fd = obj.fileno()
+        self._objs[fd] = obj
+        self._p.register(fd, mask)
+
+    def modify(self, obj, mask):
+        self._p.modify(obj.fileno(), mask)
+
+    def unregister(self, obj):
+        for fd, o in self._objs.items():
+            if o is obj:
+                del self._objs[fd]
+                self._p.unregister(fd)
+                return
+        raise KeyError(obj)
+
+    def poll(self, timeout=-1):
+        return [(self._objs[fd], ev) for fd, ev in self._p.poll(timeout)]
+
+    def ipoll(self, timeout=-1, flags=0):
+        return self.poll(timeout)
+
+
+# --- socket: accept the SOL_SOCKET,20 callback option, stream-style readinto() ---------
+
+_watched = weakref.WeakSet() # sockets with a callback set
+
+
+class _Socket(_socket.socket):
+    cb = None
+
+    def setsockopt(self, level, opt, val):
+        if level == _socket.SOL_SOCKET and opt == 20:
+            self.cb = val # micropython's "call me when readable"; fired by run_callbacks()
+            _watched.add(self)
+            return
+        return super().setsockopt(level, opt, val)
+
+    def accept(self):
+        fd, addr = self._accept()
+        return _Socket(self.family, self.type, self.proto, fileno=fd), addr
+
+    def readinto(self, buf, n=None):
+        try:
+            return self.recv_into(buf, n or 0)
+        except BlockingIOError:
+            return None
+
+
+def run_callbacks():
+    """Fire the SOL_SOCKET,20 callbacks of sockets that are readable now, as lwip would when data or a connection arrives."""
+    socks = [s for s in list(_watched) if s.fileno() >= 0]
+    if socks:
+        for s in _select.select(socks, [], [], 0)[0]:
+            s.cb(s)
+
+
+def install():
+    """Register the stand-in modules.  Under micropython (unix port) only the missing ones are added."""
+    builtins.const = getattr(builtins, 'const', lambda x: x)
+    if not _is_mpy:
+        time.ticks_ms = _ticks_ms
+        time.ticks_us = _ticks_us
+        time.ticks_diff = _ticks_diff
+        time.ticks_add = _ticks_add
+        time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+        time.sleep_us = lambda us: time.sleep(us / 1000000)
+    mods = {
+        'machine': _mod('machine', WDT=_WDT),
+        'network': _mod('network', AP_IF=1, STA_IF=0, WLAN=_WLAN),
+        'uio': _mod('uio', IOBase=_IOBase),
+        'uhashlib': hashlib,
+        'micropython': _mod('micropython', const=lambda x: x, schedule=_schedule),
+    }
+    uos = _mod('uos', **{k: getattr(os, k) for k in dir(os) if not k.startswith('__')})
+    uos.dupterm = _dupterm
+    uos.dupterm_notify = _dupterm_notify
+    uos.uname = lambda: _uname
+    mods['uos'] = uos
+    for k, v in mods.items():
+        if not _is_mpy or k not in sys.modules:
+            sys.modules.setdefault(k, v)
+
+
+def load_telnetd():
+    """Import telnetd with the shims in place.  telnetd gets MP-flavoured select/socket modules;
+    the rest of the process keeps the real ones."""
+    install()
+    here = os.path.dirname(os.path.abspath(__file__))
+    top = os.path.dirname(here)
+    if top not in sys.path:
+        sys.path.insert(0, top)
+    saved = sys.modules.get('select'), sys.modules.get('socket')
+    if not _is_mpy:
+        sys.modules['select'] = _mod('select', **{k: getattr(_select, k) for k in dir(_select) if k.isupper()}, poll=_Poll, select=_select.select)
+        sys.modules['socket'] = _mod('socket', **{k: getattr(_socket, k) for k in dir(_socket) if not k.startswith('__')})
+        sys.modules['socket'].socket = _Socket
+    try:
+        sys.modules.pop('telnetd', None)
+        import telnetd
+    finally:
+        if not _is_mpy:
+            sys.modules['select'], sys.modules['socket'] = saved
+    return telnetd
+
+
+def socketpair():
+    """A connected (server-side, client-side) pair; the server side is the shimmed socket class."""
+    a, b = _socket.socketpair()
+    s = _Socket(a.family, a.type, a.proto, fileno=a.detach())
+    return s, b
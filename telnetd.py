@@ -10,9 +10,8 @@ import sys
 import time
 import select
 import socket
-import gc
-import machine
 import uio
+import micropython
 
 iac_cmds = [ # These need to be sent with specific timing to tell the client not to echo locally and exit line mode
             # First set of commands from the server
@@ -34,42 +33,492 @@ iac_cmds = [ # These need to be sent with specific timing to tell the client not
             b'\xff\xfd\x06'  # IAC DO LFLOW
             b'\xff\xfb\x01'  # IAC WILL ECHO
 ]
+
+_WILL_OPTS = (1, 3, 5)                  # options iac_cmds offers (WILL) ...
+_DO_OPTS = (1, 6, 24, 31, 32, 35, 39)   # ... and asks the client for (DO)
+
+# _iac() parser states
+_T_DATA = const(0)
+_T_CR = const(1)
+_T_IAC = const(2)
+_T_OPT = const(3)
+_T_SB = const(4)
+_T_SBIAC = const(5)
+
+_BLANK = b' ' * 256 # recv buffers are kept full of this outside of a read, so "b'\xff' in buf" only finds what was just read
+
+_FULL = b'Too many telnet sessions; try again later.\r\n' # all a client gets when max_sessions are open
+
+_PERR = select.POLLHUP | select.POLLERR # poll() events that mean the client is gone
+
+
+class _AStream: # socket-like front for an asyncio client stream, so async clients go through the same code as polled sockets
+    def __init__(self, w):
+        import asyncio
+        self.w = w
+        self.ev = asyncio.Event() # set when there is something for _awriter() to drain
+
+    def send(self, b): # takes it all; _awriter() drains the stream before it writes the next lot from the session's buffer
+        self.w.write(bytes(b))
+        self.ev.set()
+        return len(b)
+
+    def close(self):
+        self.w.close()
+
+
+# Session.state flags
+_S_NEG = const(1)   # handshake still running (see _negotiate)
+_S_LOGIN = const(2) # hasn't given the password yet
+_S_XFER = const(4)  # agreed to the upload option
+_S_DROP = const(8)  # compressed output didn't fit in its buffer, and none of it can be left out; closed at the next chance
+
+_XFER = const(201)  # private telnet option for file uploads (see _xfer_sb and tools/tnput.py)
+_MCCP = const(86)   # COMPRESS2: output compression (see _Deflate)
+_XBLK = const(4096) # uploads are written to flash in blocks of this size
+
+
+class Session: # one client connection. Fixed slots and integer flags: small, and no string-keyed lookups on the byte paths
+    __slots__ = ('sock', 'addr', 'state', 'pw', 'neg', 'seen', 't', 'iac', 'verb', 'sb', 'sbn', 'buf', 'st', 'xf', 'z', 'id', 'ed', 'ech')
+
+    def __init__(self, sock, addr, obuf):
+        self.sock = sock          # socket, or _AStream in async mode
+        self.addr = addr          # client address
+        self.state = _S_NEG | _S_LOGIN
+        self.pw = ""              # password typed so far
+        self.neg = 0              # handshake round (see _negotiate)
+        self.seen = False         # client has sent something since the last round
+        self.t = 0                # when the last round went out
+        self.iac = _T_DATA        # telnet command parser state (see _iac)
+        self.verb = 0
+        self.sb = bytearray(80)   # subnegotiation being collected (room for an upload's file name)
+        self.sbn = 0
+        self.buf = RingBuf(obuf)  # output waiting for the socket
+        self.st = ClientStats()
+        self.xf = None            # _Xfer, while an upload is streaming in
+        self.z = None             # _Deflate, once the client has agreed to compression
+        self.id = 0               # connection number, for the transcript
+        self.ed = None            # its own LineEditor, in line mode (see telnetd.line_mode)
+        self.ech = None           # in line mode, the REPL's echo of the line it was last given, still to be cut out of this client's output
+
+
+class _Deflate: # MCCP2 compressor for one session: one zlib stream for everything sent after IAC SB COMPRESS2 IAC SE, sync-flushed by every compress()
+    __slots__ = ('io', 'z', 'out')
+
+    def __init__(self, wbits):
+        self.out = bytearray()
+        try:
+            import deflate # micropython: DeflateIO compresses into self.write()
+            self.io = deflate.DeflateIO(self, deflate.ZLIB, wbits)
+            self.z = None
+        except ImportError:
+            import zlib # CPython (the benchmarks)
+            self.z = zlib.compressobj(6, zlib.DEFLATED, max(wbits, 9))
+
+    def write(self, b):
+        self.out += b
+        return len(b)
+
+    def compress(self, data): # returns the compressed bytes for data, ending on a byte boundary the client can decode up to
+        if self.z:
+            return self.z.compress(data) + self.z.flush(2) # Z_SYNC_FLUSH
+        self.io.write(data)
+        self.io.flush()
+        r = bytes(self.out)
+        self.out = bytearray()
+        return r
+
+    def finish(self): # end of the stream, for a client that turns compression off
+        if self.z:
+            return self.z.flush()
+        self.io.close()
+        return bytes(self.out)
+
+    @staticmethod
+    def available(): # can this build make flushable compressors? Stock micropython can't: its DeflateIO (when built with MICROPY_PY_DEFLATE_COMPRESS at all) has no flush(), and MCCP needs one after every write
+        try:
+            import deflate
+            return hasattr(deflate.DeflateIO, 'write') and hasattr(deflate.DeflateIO, 'flush')
+        except ImportError:
+            pass
+        try:
+            import zlib
+            return hasattr(zlib, 'compressobj')
+        except ImportError:
+            return False
+
+
+class _Xfer: # one upload in progress. Only whole blocks are written until the last, so a .part file left by a dropped connection ends on a block boundary and can be resumed
+    __slots__ = ('name', 'f', 'left', 'crc', 'want', 'mv', 'fill')
+
+    def __init__(self, name, f, left, crc, want):
+        self.name = name # where it goes once complete; it's written to name.part until then
+        self.f = f
+        self.left = left # bytes still to come
+        self.crc = crc   # crc32 of what's been written so far
+        self.want = want # crc32 the client says the whole file has
+        self.mv = memoryview(bytearray(_XBLK)) # the socket is read straight into this
+        self.fill = 0
+
+
+class ClientStats: # per-client counters; plain ints in slots, so counting never allocates
+    __slots__ = ('rx', 'tx', 'drop', 'partial', 'last', 't0', 'neg_ms', 'zin', 'rtx', 'rt')
+
+    def __init__(self):
+        self.rx = self.tx = self.drop = self.partial = self.neg_ms = self.zin = self.rtx = 0
+        self.t0 = self.last = self.rt = time.ticks_ms() # connected / last input / last seen taking output (by _reap: tx was rtx then)
+
+
+class ServerStats: # counters for the whole server. Times are kept as seconds + microseconds so they stay small ints
+    __slots__ = ('accepts', 'rejects', 'full', 'evicted', 'auth_fail', 'read_n', 'read_s', 'read_us', 'send_n', 'send_s', 'send_us', 'zip_s', 'zip_us',
+                 'hist', 'stalls', 'worst', 'wdt_skip')
+
+    def __init__(self):
+        self.accepts = self.rejects = self.full = self.evicted = self.auth_fail = 0
+        self.read_n = self.read_s = self.read_us = 0
+        self.send_n = self.send_s = self.send_us = 0
+        self.zip_s = self.zip_us = 0
+        self.hist = [0] * 16 # loop passes by how long they took: [0] under 1ms, [i] 2**(i-1) to 2**i ms, [15] the rest
+        self.stalls = 0      # passes that took stall_ms or more
+        self.worst = 0       # longest pass, ms
+        self.wdt_skip = 0    # watchdog feeds held back because a pass was stuck
+
+    def read(self, t0): # a read_input() pass that started at ticks_us() t0; returns how long it took
+        us = time.ticks_diff(time.ticks_us(), t0)
+        self.read_n += 1
+        self.read_us += us
+        while self.read_us >= 1000000:
+            self.read_s += 1
+            self.read_us -= 1000000
+        return us
+
+    def send(self, t0): # likewise for send_chars_to_all()
+        us = time.ticks_diff(time.ticks_us(), t0)
+        self.send_n += 1
+        self.send_us += us
+        while self.send_us >= 1000000:
+            self.send_s += 1
+            self.send_us -= 1000000
+        return us
+
+    def lat(self, us, stall_ms): # one pass of the poll/flush loop took us microseconds
+        ms = us // 1000
+        if ms > self.worst:
+            self.worst = ms
+        if ms >= stall_ms:
+            self.stalls += 1
+        i = 0
+        while ms and i < 15:
+            ms >>= 1
+            i += 1
+        self.hist[i] += 1
+
+    def zip(self, t0): # time spent compressing
+        self.zip_us += time.ticks_diff(time.ticks_us(), t0)
+        while self.zip_us >= 1000000:
+            self.zip_s += 1
+            self.zip_us -= 1000000
+
+
+class RingBuf: # fixed-size output buffer for one client; preallocated so queuing output never allocates
+    __slots__ = ('buf', 'mv', 'size', 'head', 'n')
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.size = size
+        self.head = 0 # oldest byte
+        self.n = 0    # bytes queued
+
+    def put(self, data): # copy in as much of data as fits; returns how many bytes that was
+        k = min(len(data), self.size - self.n)
+        t = (self.head + self.n) % self.size
+        a = min(k, self.size - t) # up to the end of the buffer, then wrap
+        self.mv[t:t + a] = data[:a]
+        if k > a:
+            self.mv[:k - a] = data[a:k]
+        self.n += k
+        return k
+
+    def drop(self, k): # discard the k oldest bytes
+        k = min(k, self.n)
+        self.head = (self.head + k) % self.size
+        self.n -= k
+        if not self.n:
+            self.head = 0
+        return k
+
+    def drop_lines(self, k): # discard at least k of the oldest bytes, stopping just after a newline so we never cut an escape sequence in half
+        i = k - 1
+        while i < self.n:
+            if self.buf[(self.head + i) % self.size] == 10: # \n
+                return self.drop(i + 1)
+            i += 1
+        return self.drop(self.n) # no line boundary left; throw it all away
+
+    def get(self, b): # copy the oldest bytes out into b (as many as fit); returns how many
+        k = min(len(b), self.n)
+        a = min(k, self.size - self.head)
+        b[:a] = self.mv[self.head:self.head + a]
+        if k > a:
+            b[a:k] = self.mv[:k - a]
+        return self.drop(k)
+
+    def send(self, sock): # send what we can without blocking; returns bytes sent. Raises OSError for anything other than EAGAIN
+        sent = 0
+        while self.n:
+            a = min(self.n, self.size - self.head)
+            try:
+                b = sock.send(self.mv[self.head:self.head + a])
+            except OSError as e:
+                if e.args[0] != 11: # EAGAIN: not writable right now, keep it buffered
+                    raise
+                b = 0
+            if not b:
+                break
+            self.drop(b)
+            sent += b
+            if b < a:
+                break # partial send: the socket is full
+        return sent
     
 
+class _Transcript: # session log (see telnetd.transcript). Collected in RAM and written out in whole blocks that line up with the file's block boundaries,
+    # so flash sees a few large aligned writes instead of one per dupterm chunk
+    # A write that fails (flash full, say) ends the transcript: it's closed and dropped from the telnetd, and nothing is raised to the I/O paths
+    __slots__ = ('t', 'path', 'max', 'keep', 'blk', 'buf', 'mv', 'fill', 'f', 'size', 'last')
+
+    def __init__(self, t, path, max, keep, blk):
+        self.t = t       # the telnetd, whose _log this is
+        self.path = path
+        self.max = max   # rotate once the file reaches this size ...
+        self.keep = keep # ... keeping this many old ones as path.1, path.2, ...
+        self.blk = blk
+        self.buf = bytearray(2 * blk)
+        self.mv = memoryview(self.buf)
+        self.fill = 0
+        self.f = open(path, 'ab')
+        self.size = self.f.seek(0, 2)
+        self.last = None # who the last record was from, so the marker is only written when that changes
+
+    def rec(self, tag, sid, data): # log data, marked with its direction/event (tag) and session number when those change
+        if self.f is None:
+            return
+        try:
+            if self.last != (tag, sid):
+                self.last = (tag, sid) if tag in '<>' else None
+                self.put('\x1e{}{}\x1f'.format(tag, sid).encode())
+            if data:
+                self.put(data)
+        except OSError:
+            self._fail()
+
+    def _fail(self): # give up on the file
+        try:
+            self.f.close()
+        except OSError:
+            pass
+        self.f = None
+        self.fill = 0
+        if self.t._log is self:
+            self.t._log = None
+
+    def put(self, data):
+        mv = memoryview(data)
+        while mv:
+            k = min(len(mv), len(self.buf) - self.fill)
+            self.mv[self.fill:self.fill + k] = mv[:k]
+            self.fill += k
+            mv = mv[k:]
+            while self.fill >= self.blk - self.size % self.blk: # a whole block's worth (up to the next boundary)
+                self._write(self.blk - self.size % self.blk)
+
+    def _write(self, k): # the first k bytes of buf to the file
+        self.f.write(self.mv[:k])
+        self.size += k
+        self.fill -= k
+        self.mv[:self.fill] = self.mv[k:k + self.fill]
+        if self.size >= self.max:
+            self._rotate()
+
+    def _rotate(self):
+        self.f.close()
+        for i in range(self.keep, 0, -1):
+            try:
+                uos.rename(self.path + ('.{}'.format(i - 1) if i > 1 else ''), '{}.{}'.format(self.path, i))
+            except OSError:
+                pass
+        if not self.keep:
+            uos.remove(self.path)
+        self.f = open(self.path, 'wb')
+        self.size = 0
+
+    def flush(self): # everything collected so far to flash (the one time a write may be short)
+        if self.f is None:
+            return
+        try:
+            if self.fill:
+                self._write(self.fill)
+            self.f.flush()
+        except OSError:
+            self._fail()
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self._fail()
+
+
 class telnetd(uio.IOBase):
 
-    def __init__(self):
-        import os
+    def __init__(self): # nothing here touches the network, the filesystem or the hardware; telnetd() does that
         self.server_socket = None
-        self.sockets = []  # Dict of open TCP/IP client_socket connections for both input and output ['sock'] is the socket. ['addr'] is the client address. ['buf'] is the socket buffer. ['r'], ['w'], ['e'] is the state
-
-        self._nbuf = ""
-        self._line = ""
-        self._cursor_pos = 0
-        self._lastread = time.ticks_ms()
-        self._esc_seq = ""
-        self._reading_esc = False
-        self._insert_mode = True  # Default to insert mode
-        self._hist_loc = -1  # Start with the most recent command (has 1 added before use; 0 means last)
+        self.sockets = []  # Session for each open TCP/IP client connection, for both input and output
+        self._aserver = None # asyncio server, in async mode
+        self._nunauth = 0  # connections not logged in yet (handshake or password)
+        self._fails = {}   # source IP -> [wrong passwords, no new connections until ticks_ms()]
+        self.max_unauth = 2          # connections allowed to be at the password prompt at once
+        self.auth_timeout = 30000    # ms to get the password right
+        self.auth_backoff = 1000     # ms an IP must wait after a wrong password; doubles each time ...
+        self.auth_backoff_max = 60000 # ... up to this
+        self.backlog = 2             # connections the network stack holds for us until they're accepted
+        self.max_sessions = 8        # sessions at once, logged in or not; more are turned away with _FULL ...
+        self.evict_idle = 0          # ... unless a logged-in one has been idle this many ms (0: never evict), in which case the longest-idle one makes room
+        self.idle_timeout = 0        # ms without input after which a logged-in session is closed (0: never; an observer may just be watching)
+        self.dead_timeout = 60000    # ms a session's output may sit queued with the socket taking none of it before the session is taken for dead
+        self.keepalive = 60          # s of quiet before the TCP stack starts keepalive probes (0: no keepalive)
+        self.reap_ms = 5000          # how often _reap() looks for all of the above
+        self._reap_due = 0
+        self._stats = ServerStats()
+        self._socks = {}   # socket -> its Session, so poll() results map straight back to their client
+        self._poll = select.poll() # one registry for the server and all client sockets; a single ipoll(0) per tick returns only the ready ones
+
+        self._in = RingBuf(1024) # client input waiting for dupterm's readinto()
+        self._pool = [bytearray(_BLANK) for i in range(2)] # recv buffers: read_input() uses [0], async readers borrow the others
+        self._ed = None # line editor, once something uses it (see _editor)
+        self._log = None # _Transcript, if transcript() was called
+
+        self._xbuf = bytearray(256) # scratch for CRLF conversion of outgoing data
+        self._cr = False            # last byte written was \r
+        self.coalesce_ms = 5      # hold output back this long (0: send every write() at once) ...
+        self._cbuf = bytearray(512) # ... or until this fills
+        self._cn = 0              # bytes waiting in _cbuf
+        self._cdue = 0            # when they must go
+        self._sched = False       # the deadline timer is armed
+        self.coalesce_timer = None # None: no timer, so the deadline is only checked when dupterm polls and on read_input() (and a program that's busy printing
+                                   # waits for it). Or a machine.Timer id to take for the deadline: -1 for a virtual timer where the port has them, else a hardware
+                                   # timer your own code doesn't use (on ESP32 any id claims one of the four hardware timers)
+        self._tmr = None
+        self._tmr_cb = self._tmr_fire # bound once, so the timer interrupt doesn't allocate
+        self._due_cb = self._flush_due
+        self._echo_until = 0      # output before this is echo, and isn't held back
+        self.obuf_size = 2048     # per-client output buffer
+        self.obuf_hi = 1536       # above this, the overflow policy kicks in ...
+        self.obuf_lo = 512        # ... and brings it back down to here
+        self.obuf_policy = 'drop' # 'drop' oldest lines, 'close' the slow client, or 'block' the REPL until it catches up
+        self.obuf_wait = 2000     # ms that 'block' waits for a client before falling back to 'drop'
+        self.compress = None      # offer MCCP2 output compression to clients once they've logged in (None: if this build can; decided at the first login)
+        self.compress_wbits = 10  # its window: 1 KB per compressing client (plus the compressor's own state)
+        self.line_mode = False    # edit lines here, per session (echo, cursor keys, history), and give the REPL only whole lines; for sessions that log in after it's set
+        self.line_hist = 10       # lines of history each line editor keeps
+        self._lm = False          # what's in _in came from a line-mode session (its echo isn't anyone's keystroke echo)
+        self._lq = None           # input that didn't fit in _in (a long line-mode line, or async readers that read into the same room at once); nothing
+                                  # more is read from the sockets until it has gone in (see _repl_in)
 
         self._TERM_WIDTH = 80
         self._TERM_HEIGHT = 24
         self._TERM_TYPE = ""
         self._TERM_TYPE_EX = ""
+        self._TERM_SPEED = ""
         self._wdt = None
-        if 'wdt.up' in os.listdir('/'):
+        self._busy = None         # ticks_ms() when the loop pass now running started (read_input() or send_chars_to_all()), None between passes
+        self._tick = time.ticks_ms() # when the last pass finished
+        self.stall_ms = 100       # a pass that takes this long counts as a stall in stats()
+        self.wdt_budget = 60000   # the watchdog is only fed while no pass has been running longer than this
+
+    def _watchdog(self): # start the watchdog feeder if /wdt.up exists (see README)
+        if self._wdt is None and 'wdt.up' in uos.listdir('/'):
             import _thread
+            import machine
             print("Starting Watchdog Feeder")
             self._wdt = machine.WDT(timeout=200000) # give it 3.33 minutes to run what we want before resetting and trying again (enough time to upload 2MB at 115200 baud)
             _thread.start_new_thread(self.feed_wdt,())
 
     def feed_wdt(t):
+        stuck = False
         while True:
             time.sleep(15)
-            # maybe check socket stuff here?
-            t._wdt.feed() # prevent reboot as long as we are running OK
+            if t._live():
+                t._wdt.feed() # prevent reboot as long as we are running OK
+                stuck = False
+            else:
+                t._stats.wdt_skip += 1
+                if not stuck: # leave a note for after the reboot
+                    t._stall_note()
+                stuck = True
             #print(".",end='')
 
+    def _live(self): # is the loop getting round? (a pass that's been running longer than wdt_budget means it's stuck)
+        b = self._busy
+        return b is None or time.ticks_diff(time.ticks_ms(), b) < self.wdt_budget
+
+    def _stall_note(self): # runs on the feeder thread while the loop is stuck; the watchdog will reset the board soon after
+        try:
+            s = self.stats()
+            with open('/wdt.log', 'a') as f:
+                f.write('{} stuck {}ms stalls {} worst {}ms hist {}\n'.format(time.ticks_ms(), time.ticks_diff(time.ticks_ms(), self._busy or 0), s['stalls'], s['stall_worst_ms'], s['loop_hist']))
+        except Exception:
+            pass
+
+    def _pass_end(self, us): # an outermost loop pass is done (nested ones, e.g. send_chars_to_all() from inside read_input(), are part of it)
+        self._busy = None
+        self._tick = time.ticks_ms()
+        self._stats.lat(us, self.stall_ms)
+        if time.ticks_diff(self._tick, self._reap_due) >= 0:
+            self._reap(self._tick)
+
+    # Close the sessions that are dead or have overstayed: not logged in within auth_timeout, no input for idle_timeout, or output queued for
+    # dead_timeout with the socket taking none of it (a peer that vanished without a FIN). Runs every reap_ms, from the end of a loop pass in poll
+    # mode and from _areaper() in async mode, rather than on every I/O call
+    def _reap(self, now):
+        self._reap_due = time.ticks_add(now, self.reap_ms)
+        dead = []
+        for client_socket in self.sockets:
+            st = client_socket.st
+            if client_socket.state & _S_LOGIN:
+                if time.ticks_diff(now, st.t0) > self.auth_timeout:
+                    dead.append(client_socket)
+                continue
+            if self.idle_timeout and not client_socket.xf and time.ticks_diff(now, st.last) > self.idle_timeout:
+                dead.append(client_socket)
+                continue
+            if client_socket.buf.n and not self._aserver: # give leftovers a push (nothing else will if the REPL has gone quiet), which also shows whether it's taking any
+                try:
+                    st.tx += client_socket.buf.send(client_socket.sock)
+                except OSError:
+                    dead.append(client_socket)
+                    continue
+            if st.tx != st.rtx or not client_socket.buf.n: # it's taking output (or has none waiting)
+                st.rtx = st.tx
+                st.rt = now
+            elif time.ticks_diff(now, st.rt) > self.dead_timeout:
+                dead.append(client_socket)
+        self._del_old_socks(dead)
+
+    # Have the TCP stack probe connections that go quiet, so one whose far end has gone (a laptop that slept or roamed) errors out and is closed,
+    # where the port supports it
+    def _keepalive(self, sock):
+        if not self.keepalive or sock is None:
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'): # otherwise the stack's default (often 2 hours) applies
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        except (AttributeError, OSError):
+            pass
+
 
     def print_console_message(self,msg):
         pass # cannot print messages, because dupterm calls itself recursively which breaks stuff...
@@ -78,254 +527,474 @@ class telnetd(uio.IOBase):
     def accept_telnet_connect(self,unused):
         global iac_cmds
         #print("accept_telnet_connect:",self,unused)
-        client_sock, client_addr = self.server_socket.accept() # client_socket['sock'] is the socket, client_socket['addr'] is the address
-
-        self.sockets.append({
-            'sock': client_sock,
-            'addr': client_addr, 
-            'buf': b'', 
-            'r': "", 
-            'w': "", 
-            'e': "",
-            'a': "" # unauthenticated
-        })
+        while True: # take everything that's waiting: after an AP restart the whole fleet reconnects at once, and the backlog only holds so many
+            try:
+                client_sock, client_addr = self.server_socket.accept() # client_socket.sock is the socket, client_socket.addr is the address
+            except OSError:
+                return # EAGAIN: that was all of them (or the other path, callback vs. poll, already took it)
+            if not self._admit(client_addr):
+                client_sock.close() # before we've sent (or allocated) anything for it
+                continue
+            if self._full():
+                try:
+                    client_sock.send(_FULL)
+                except OSError:
+                    pass
+                client_sock.close()
+                continue
+
+            client_sock.setblocking(False)
+            self._keepalive(client_sock)
+            self._poll.register(client_sock, select.POLLIN)
+            client_sock.setsockopt(socket.SOL_SOCKET, 20, uos.dupterm_notify) # the client's negotiation replies wake us up to send the next round
+            self._add_client(client_sock, client_addr)
+
+    # Cheap early check for a new connection: refuse IPs still backing off after a wrong password, and floods of connections that aren't logging in
+    def _admit(self, client_addr):
+        f = self._fails.get(client_addr[0])
+        if self._nunauth >= self.max_unauth or f and time.ticks_diff(f[1], time.ticks_ms()) > 0:
+            self._stats.rejects += 1
+            return False
+        return True
+
+    # At max_sessions, make room if evict_idle allows: the logged-in session that has been idle longest goes, if that's been evict_idle ms or more.
+    # Returns True if there is still no room
+    def _full(self):
+        if len(self.sockets) < self.max_sessions:
+            return False
+        if self.evict_idle:
+            old = None
+            for client_socket in self.sockets:
+                if not client_socket.state & _S_LOGIN and not client_socket.xf and (old is None or time.ticks_diff(old.st.last, client_socket.st.last) > 0):
+                    old = client_socket
+            if old and time.ticks_diff(time.ticks_ms(), old.st.last) >= self.evict_idle:
+                if not old.z: # (a compressing client can't be sent plain text)
+                    try:
+                        old.sock.send(b'\r\nDisconnected to make room for a new session.\r\n')
+                    except OSError:
+                        pass
+                self._stats.evicted += 1
+                self._del_old_socks([old])
+                return False
+        self._stats.full += 1
+        return True
+
+    # Wrong password from ip: make it wait before it may connect again, exponentially longer each time
+    def _auth_failed(self, ip):
+        now = time.ticks_ms()
+        f = self._fails.get(ip)
+        if f is None:
+            if len(self._fails) >= 16: # keep the table small: forget IPs that have served their time, or failing that, any one
+                for k in [k for k, v in self._fails.items() if time.ticks_diff(v[1], now) <= 0] or [next(iter(self._fails))]:
+                    del self._fails[k]
+            f = self._fails[ip] = [0, now]
+        f[0] += 1
+        f[1] = time.ticks_add(now, min(self.auth_backoff << min(f[0] - 1, 16), self.auth_backoff_max))
+
+    # Start a session for a new connection (sock is a socket, or an _AStream in async mode). Returns its Session, or None if it was dropped
+    def _add_client(self, client_sock, client_addr):
+        client_socket = Session(client_sock, client_addr, self.obuf_size)
+        self.sockets.append(client_socket)
+        self._socks[client_sock] = client_socket
+        self._stats.accepts += 1
+        client_socket.id = self._stats.accepts
 
         self.print_console_message("Telnet connection from {}".format(client_addr))
-        client_sock.setblocking(False)
-
-        # Tell the new connection to set up their terminal for us
-        for i, cmd in enumerate(iac_cmds + [b'Password: ']):
-            #print("sent: ", binascii.hexlify(cmd))
-            client_sock.send(cmd)
-            # Wait for the client to respond
-            time.sleep(0.1)
-            if i>2:
-                ready_to_read, _, _ = select.select([client_sock], [], [], 5)
-                if ready_to_read:
-                    time.sleep(0.1) # give it enough time to finish sending its terminal size/etc info to us, before we discard that.
-                    ignore = client_sock.recv(1024)
-                    #if ignore:
-                    #    print("got: ", binascii.hexlify(ignore)) #        b'fffa200033383430302c3338343030fff0fffa27000358415554484f52495459012f686f6d652f636e642f2e58617574686f72697479fff0fffa18004c494e5558fff0fffc01fffa1f01180073fff0fffb06fffd01'
-                                                                 # data:  b'fffd03fffb18fffb1ffffb20fffb21fffb22fffb27fffd05fffc23'
-                                                                 # data:  b'fffa200033383430302c3338343030fff0fffa27000358415554484f52495459012f686f6d652f636e642f2e58617574686f72697479fff0fffa18004c494e5558fff0'
-                                                                 # data:                                                                                                                                        b'fffc01fffa1f01180073fff0fffb06fffd01'
-                else:
-                    self.print_console_message(f"No response from telnet client {client_addr} within timeout. Disconnected")
-                    client_sock.close()
-                    del self.sockets[-1]
-
-        client_sock.setblocking(False)
-        client_sock.setsockopt(socket.SOL_SOCKET, 20, uos.dupterm_notify) # keep this here; moving it up causes input weirdness
 
+        # Tell the new connection to set up their terminal for us. The rest of the rounds go out from read_input() via _negotiate()
+        self._nunauth += 1
+        if not self._negotiate(client_socket, time.ticks_ms()):
+            self._del_old_socks([client_socket])
+            return None
+        return client_socket
+
+    # Strip telnet commands out of data from one client, acting on the option negotiation as it goes. The parser state lives in the
+    # Session, so commands split across recv()s are fine. Also drops the NUL that follows CR (NVT newline). Works in place on buf[:n];
+    # returns the length of the plain data left at the start of buf
+    def _iac(self, client_socket, buf, n):
+        st = client_socket.iac
+        if st <= _T_CR and b'\xff' not in buf and b'\x00' not in buf: # nothing to do (almost always); a C-speed search of the whole (otherwise blank) buffer
+            client_socket.iac = _T_CR if buf[n - 1] == 13 else _T_DATA
+            return n
+        sb = client_socket.sb
+        sbn = client_socket.sbn
+        verb = client_socket.verb
+        j = 0 # compacting in place: the write position never passes the read position
+        for i in range(n):
+            c = buf[i]
+            if st <= _T_CR:
+                if c == 255: # IAC
+                    st = _T_IAC
+                elif c == 0 and st == _T_CR:
+                    st = _T_DATA
+                else:
+                    buf[j] = c
+                    j += 1
+                    st = _T_CR if c == 13 else _T_DATA
+            elif st == _T_IAC:
+                st = _T_DATA
+                if c == 255: # escaped 0xff data byte
+                    buf[j] = c
+                    j += 1
+                elif c >= 251: # WILL WONT DO DONT, option byte follows
+                    verb = c
+                    st = _T_OPT
+                elif c == 250: # SB
+                    sbn = 0
+                    st = _T_SB
+                elif c == 244: # IP - interrupt process
+                    buf[j] = 3 # ^C
+                    j += 1
+            elif st == _T_OPT:
+                self._iac_opt(client_socket, verb, c)
+                st = _T_DATA
+            elif st == _T_SB:
+                if c == 255:
+                    st = _T_SBIAC
+                elif sbn < len(sb):
+                    sb[sbn] = c
+                    sbn += 1
+                else: # didn't fit: len(sb) + 1 tells _iac_sb it was cut short
+                    sbn = len(sb) + 1
+            else: # _T_SBIAC
+                if c == 240: # SE
+                    self._iac_sb(client_socket, sb, sbn)
+                    st = _T_DATA
+                else: # IAC IAC inside SB
+                    if sbn < len(sb):
+                        sb[sbn] = c
+                        sbn += 1
+                    else:
+                        sbn = len(sb) + 1
+                    st = _T_SB
+        client_socket.iac = st
+        client_socket.sbn = sbn
+        client_socket.verb = verb
+        return j
+
+    # Answer WILL/WONT/DO/DONT: agree to what we asked for, refuse anything else. Nothing is sent for what we already asked for or for WONT/DONT,
+    # so the two sides can't loop
+    def _iac_opt(self, client_socket, verb, opt):
+        r = None
+        if verb == 251: # WILL
+            if opt == 24: # TERMINAL-TYPE: (re-)ask for it now that the client has agreed
+                r = b'\xff\xfa\x18\x01\xff\xf0'
+            elif opt == _XFER and not client_socket.state & _S_LOGIN: # the upload tool, once logged in
+                if not client_socket.state & _S_XFER:
+                    client_socket.state |= _S_XFER
+                    r = bytes((255, 253, opt)) # DO
+            elif opt not in _DO_OPTS:
+                r = bytes((255, 254, opt)) # DONT
+        elif verb == 253 and opt == _MCCP and self.compress and not client_socket.state & _S_LOGIN: # DO COMPRESS2, to our offer at login
+            if not client_socket.z:
+                if client_socket.buf.put(b'\xff\xfa\x56\xff\xf0') < 5: # IAC SB COMPRESS2 IAC SE: the last thing it gets uncompressed
+                    client_socket.state |= _S_DROP
+                client_socket.z = _Deflate(self.compress_wbits)
+            self.send_chars_to_all(b'')
+        elif verb == 254 and opt == _MCCP and client_socket.z: # DONT COMPRESS2
+            z = client_socket.z.finish()
+            if client_socket.buf.put(z) < len(z):
+                client_socket.state |= _S_DROP
+            client_socket.z = None
+            self.send_chars_to_all(b'')
+        elif verb == 253 and opt not in _WILL_OPTS: # DO
+            r = bytes((255, 252, opt)) # WONT
+        if r and (client_socket.z or self._aserver): # replies have to go in the compressed stream, in order; async streams are only written by _awriter()
+            self._queue(client_socket, r)
+        elif r:
+            try:
+                client_socket.sock.send(r)
+            except OSError:
+                pass
+
+    def _queue(self, client_socket, data): # output for one client only (compressed if it's compressing), sent with the next send_chars_to_all()
+        z = client_socket.z
+        if z:
+            client_socket.st.zin += len(data)
+            data = z.compress(data)
+        if client_socket.buf.put(data) < len(data) and z: # bytes can't be left out of a compressed stream
+            client_socket.state |= _S_DROP
+        if self._aserver:
+            client_socket.sock.ev.set()
+
+    # A complete subnegotiation: pick up terminal size, type and speed. n is len(sb) + 1 if it was longer than sb (a terminal type is just cut short)
+    def _iac_sb(self, client_socket, sb, n):
+        if not n:
+            return
+        opt = sb[0]
+        if opt == _XFER:
+            if client_socket.state & _S_XFER:
+                self._xfer_sb(client_socket, sb, n)
+        elif opt == 31 and n >= 5: # NAWS: width, height as 16-bit big-endian
+            w, h = sb[1] << 8 | sb[2], sb[3] << 8 | sb[4]
+            if w and h:
+                self._TERM_WIDTH, self._TERM_HEIGHT = w, h
+        elif n >= 2 and sb[1] == 0: # IS
+            v = bytes(sb[2:n]).decode('utf-8', 'ignore') if n > 2 else ''
+            if opt == 24: # TERMINAL-TYPE
+                self._TERM_TYPE = v
+            elif opt == 32: # TSPEED "rx,tx"
+                self._TERM_SPEED = v
+
+    # Advance one connection's handshake without blocking. iac_cmds rounds go out 100ms apart (sooner if the client answers), then the password
+    # prompt; the client then has 5s to respond. Returns False if the client should be dropped
+    def _negotiate(self, client_socket, now):
+        st = client_socket.neg
+        waited = time.ticks_diff(now, client_socket.t)
+        if st <= len(iac_cmds): # next round, or the prompt
+            if st and not client_socket.seen and waited < 100:
+                return True
+            try:
+                #print("sent: ", binascii.hexlify(cmd))
+                client_socket.sock.send(iac_cmds[st] if st < len(iac_cmds) else b'Password: ')
+            except OSError:
+                return False
+            client_socket.seen = False
+        elif client_socket.seen: # prompt sent and the client has responded; its replies go through _iac(), anything else is the password
+            client_socket.state &= ~_S_NEG
+            client_socket.st.neg_ms = time.ticks_diff(now, client_socket.st.t0)
+            return True
+        else:
+            if waited >= 5000:
+                self.print_console_message(f"No response from telnet client {client_socket.addr} within timeout. Disconnected")
+                return False
+            return True
+        client_socket.neg = st + 1
+        client_socket.t = now
+        return True
+
+    # Upload request from a client that agreed to option _XFER. Numbers are 4-byte big-endian:
+    #   IAC SB XFER 1 <name> IAC SE                          -> 3 <size> <crc32>: what name.part already holds, to resume from
+    #   IAC SB XFER 2 <offset> <size> <crc32> <name> IAC SE  -> 4 <offset>, then the client sends bytes offset..size raw -> 5 <crc32> once name is in place
+    # anything that fails is answered with 6 <code>: 1 another upload is running, 2 offset doesn't match name.part, 3 file error, 4 checksum mismatch,
+    # 5 name is longer than sb holds (66 bytes) or isn't UTF-8
+    def _xfer_sb(self, client_socket, sb, n):
+        import struct
+        cmd = sb[1] if n > 1 else 0
+        k = 2 if cmd == 1 else 14 # where the name starts
+        if cmd not in (1, 2) or n <= k:
+            return
+        if n > len(sb):
+            return self._xfer_reply(client_socket, 6, 5)
+        try:
+            name = bytes(sb[k:n]).decode()
+        except UnicodeError:
+            return self._xfer_reply(client_socket, 6, 5)
+        if cmd == 1:
+            self._xfer_reply(client_socket, 3, *self._xfer_crc(name + '.part'))
+        else:
+            off, size, want = struct.unpack_from('>III', sb, 2)
+            if any(c.xf for c in self.sockets):
+                return self._xfer_reply(client_socket, 6, 1)
+            if off:
+                have, crc = self._xfer_crc(name + '.part')
+                if have != off or off > size:
+                    return self._xfer_reply(client_socket, 6, 2)
+            else:
+                crc = 0
+            try:
+                f = open(name + '.part', 'ab' if off else 'wb')
+            except OSError:
+                return self._xfer_reply(client_socket, 6, 3)
+            client_socket.xf = _Xfer(name, f, size - off, crc, want)
+            self._xfer_reply(client_socket, 4, off)
+            if not client_socket.xf.left:
+                self._xfer_end(client_socket)
+
+    # n more upload bytes have landed in the client's _Xfer block. Returns False if the client should be dropped (the rest of its upload would be taken for typing)
+    def _xfer_data(self, client_socket, n):
+        x = client_socket.xf
+        client_socket.st.rx += n
+        client_socket.st.last = time.ticks_ms()
+        x.fill += n
+        x.left -= n
+        if x.fill == _XBLK or not x.left:
+            import binascii
+            try:
+                x.f.write(x.mv[:x.fill])
+            except OSError:
+                self._xfer_reply(client_socket, 6, 3)
+                return False
+            x.crc = binascii.crc32(x.mv[:x.fill], x.crc)
+            x.fill = 0
+            if not x.left:
+                self._xfer_end(client_socket)
+        return True
+
+    # All of an upload is in: put it in place if the checksum matches, and go back to telnet
+    def _xfer_end(self, client_socket):
+        x = client_socket.xf
+        client_socket.xf = None
+        x.f.close()
+        if x.crc != x.want:
+            try:
+                uos.remove(x.name + '.part') # no good to resume from either
+            except OSError:
+                pass
+            return self._xfer_reply(client_socket, 6, 4)
+        try:
+            uos.remove(x.name) # rename() won't replace a file on every filesystem
+        except OSError:
+            pass
+        try:
+            uos.rename(x.name + '.part', x.name)
+        except OSError:
+            return self._xfer_reply(client_socket, 6, 3)
+        self._xfer_reply(client_socket, 5, x.crc)
 
-    def telnetd(self, password, port=23, ip='0.0.0.0'): # see sh2.py which calls this via:    shell.cio.telnetd(shell,cmdenv['sw'].get('port', 23)) # tell our shell to open up the listening socket
+    def _xfer_crc(self, path): # size and crc32 of a file (0, 0 if there isn't one)
+        import binascii
+        b = bytearray(512)
+        size = crc = 0
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    k = f.readinto(b)
+                    if not k:
+                        break
+                    crc = binascii.crc32(memoryview(b)[:k], crc)
+                    size += k
+        except OSError:
+            pass
+        return size, crc
+
+    def _xfer_reply(self, client_socket, code, *vals):
+        import struct
+        r = struct.pack('>B' + 'I' * len(vals), code, *vals).replace(b'\xff', b'\xff\xff')
+        self._queue(client_socket, b'\xff\xfa' + bytes((_XFER,)) + r + b'\xff\xf0')
+        self.send_chars_to_all(b'')
+
+    def telnetd(self, password, port=23, ip='0.0.0.0', obuf=None, policy=None, mode='poll'): # see sh2.py which calls this via:    shell.cio.telnetd(shell,cmdenv['sw'].get('port', 23)) # tell our shell to open up the listening socket
         import network
-
-        # Create a non-blocking socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, 20, self.accept_telnet_connect)
-        self.server_socket.setblocking(False)
-        self.server_socket.bind((ip, port))
-        self.server_socket.listen(1)
+        if obuf:
+            self.obuf_size, self.obuf_hi, self.obuf_lo = obuf, obuf * 3 // 4, obuf // 4
+        if policy:
+            self.obuf_policy = policy
+
+        if mode == 'async': # asyncio owns the listening socket and the clients; runs once the application's event loop does
+            import asyncio
+            asyncio.create_task(self.serve(ip, port))
+        else:
+            self._listen(ip, port)
 
         self.tspassword=password
+        self._watchdog()
         for i in (network.AP_IF, network.STA_IF):
             wlan = network.WLAN(i)
             if wlan.active() and (ip=='0.0.0.0' or ip==wlan.ifconfig()[0]):
                 print("Telnet server started on {}:{}".format(wlan.ifconfig()[0], port))
 
-
-    def _read_nonblocking(self): # for STDIN only
-        if select.select([sys.stdin], [], [], 0)[0]:
-            self._nbuf += sys.stdin.read(1)
-            #self._nbuf += sys.stdin.read() # hangs
-            #print(f" got={self._nbuf} ") # cnd
-
-            i = self._nbuf.find('\n') + 1
-            if i < 1: i = None
-            ret = self._nbuf[:i]
-            self._nbuf = self._nbuf[len(ret):]
-            return ret
-        return None
-
-
-    def _process_input(self, char):
-        self._lastread = time.ticks_ms()
-        
-        if self._reading_esc:
-            self._esc_seq += char
-            if self._esc_seq[-1] in 'ABCDEFGH~Rnc': 
-                response = self._handle_esc_sequence(self._esc_seq[2:])
-                self._reading_esc = False
-                self._esc_seq = ""
-                if response:
-                    return response
-            elif time.ticks_ms() - self._lastread > 100:
-                self._reading_esc = False
-                self._esc_seq = ""
-                return self._line, "esc", self._cursor_pos
-        elif char == '\x1b':  # ESC sequence
-            self._reading_esc = True
-            self._esc_seq = char
-        elif char == '\x03':  # ctrl-C ^C
-            print("KeyboardInterrupt:")
-            raise KeyboardInterrupt
-        elif char in ['\x7f', '\b']:  # Backspace
-            if self._cursor_pos > 0:
-                self._line = self._line[:self._cursor_pos - 1] + self._line[self._cursor_pos:]
-                self._cursor_pos -= 1
-                print('\b \b' + self._line[self._cursor_pos:] + ' ' + '\b' * (len(self._line) - self._cursor_pos + 1), end='')
-        elif char in ['\r', '\n']:  # Enter
-            ret_line = self._line
-            """ for bash, not telnet
-            err='sh: !{}: event not found'
-            if ret_line.startswith("!"): # put history into buffer
-                if ret_line[1:].isdigit():
-                    nth = int(ret_line[1:])
-                    history_line = self.get_history_line(nth)
-                    if history_line:
-                        self.ins_command(history_line)
-                    else:
-                        print(err.format(nth)) # sh: !123: event not found
-                        return '' # re-show the prompt
-                else:
-                    pfx = ret_line[1:]
-                    history_line = self.search_history(pfx,0)
-                    if history_line:
-                        self.ins_command(history_line)
-                    else:
-                        print(err.format(pfx)) # sh: !{pfx}: event not found
-                        return '' # re-show the prompt
-            else:
-            """
-            if 1:
-                print('\r')
-                self._line = ""
-                self._cursor_pos = 0
-                self._hist_loc = -1
-                return ret_line, 'enter', self._cursor_pos
-
-        elif char == '\001':  # repl exit
-            return 'exit', 'enter', 0
-    
-            """ for bash, not telnet
-            elif char == '\t':  # Tab
-                #return self._line, 'tab', self._cursor_pos
-                current_input = self._line[:self._cursor_pos]
-                if any(char in current_input for char in [' ', '<', '>', '|']):
-                    # Extract the word immediately at the cursor
-                    last_space = current_input.rfind(' ') + 1
-                    #if last_space == -1:
-                    #    last_space = 0
-                    #else:
-                    #    last_space += 1
-                    word = current_input[last_space:self._cursor_pos]
-            
+    def _listen(self, ip, port):
+        # Create a non-blocking socket
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, 20, self.accept_telnet_connect)
+        self.server_socket.setblocking(False)
+        self.server_socket.bind((ip, port))
+        self.server_socket.listen(self.backlog)
+        self._poll.register(self.server_socket, select.POLLIN)
+
+    # asyncio server mode: each client gets its own reader and writer coroutine, and dupterm's readinto()/write() only move bytes through
+    # _in and the client output buffers. Use via telnetd(..., mode='async') or start(mode='async'), or await it from your own code
+    async def serve(self, ip='0.0.0.0', port=23):
+        import asyncio
+        self._aserver = await asyncio.start_server(self._aclient, ip, port, backlog=self.backlog)
+        asyncio.create_task(self._areaper())
+
+    async def _areaper(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(self.reap_ms / 1000)
+            self._reap(time.ticks_ms())
+
+    async def _aclient(self, reader, writer):
+        import asyncio
+        addr = writer.get_extra_info('peername')
+        if not self._admit(addr):
+            writer.close()
+            return
+        if self._full():
+            writer.write(_FULL)
+            try:
+                await writer.drain()
+            except Exception:
+                pass
+            writer.close()
+            return
+        a = _AStream(writer)
+        try:
+            self._keepalive(writer.get_extra_info('socket')) # CPython; micropython's streams only know their peername
+        except KeyError:
+            pass
+        client_socket = self._add_client(a, addr)
+        if client_socket is None:
+            return
+        asyncio.create_task(self._awriter(client_socket))
+        buf = self._pool.pop() if len(self._pool) > 1 else bytearray(_BLANK) # keep [0] for read_input()
+        try:
+            while client_socket in self.sockets:
+                x = client_socket.xf
+                if x: # upload streaming in
+                    data = await reader.read(min(_XBLK - x.fill, x.left))
+                    if not data:
+                        break
+                    x.mv[x.fill:x.fill + len(data)] = data
+                    if not self._xfer_data(client_socket, len(data)):
+                        break
+                    continue
+                room = 0 if self._lq else min(self._in.size - self._in.n, len(buf))
+                if not room: # the REPL hasn't caught up; leave it in the socket until it has
+                    await asyncio.sleep(0.01)
+                    continue
+                if client_socket.state & _S_NEG: # keep the handshake moving even if the client is quiet
+                    if not self._negotiate(client_socket, time.ticks_ms()):
+                        break
                     try:
-                        for entry in uos.listdir():
-                            if entry.startswith(word):
-                                self.ins_command(self._line[:self._cursor_pos] + entry[len(word):] + self._line[self._cursor_pos:])
-                                break
-                    except OSError as e:
-                        print(f"Error listing directory: {e}")
-    
+                        data = await asyncio.wait_for(reader.read(room), 0.05)
+                    except asyncio.TimeoutError:
+                        continue
                 else:
-                    from sh1 import _iter_cmds
-                    for cmd in _iter_cmds():
-                        if cmd.startswith(current_input):
-                             self.ins_command(self._line[:self._cursor_pos] + cmd[len(current_input):] + ' ' + self._line[self._cursor_pos:])
-                             break
-                    del sys.modules["sh1"]
-    
-            """
-    
-        else:
-            if self._insert_mode:
-                self._line = self._line[:self._cursor_pos] + char + self._line[self._cursor_pos:]
-                print(f'\033[@{char}', end='')  # Print char and insert space at cursor position
-            else:
-                self._line = self._line[:self._cursor_pos] + char + self._line[self._cursor_pos + 1:]
-                print(char, end='')
-            self._cursor_pos += 1
-        
-        return None
-
-    def _handle_esc_sequence(self, seq):
+                    data = await reader.read(room)
+                if not data:
+                    break # EOF
+                n = len(data)
+                buf[:n] = data
+                k = self._in.n
+                if not self._client_data(client_socket, buf, n):
+                    break
+                if self._in.n != k:
+                    uos.dupterm_notify(None) # get dupterm to come and readinto() it
+        except Exception:
+            pass # connection reset etc; it's closed below
+        self._pool.append(buf)
+        self._del_old_socks([client_socket])
+        a.ev.set() # let the writer see it's gone
+
+    # The only writer of a logged-in client's stream: what send_chars_to_all() and _queue() put in its buffer goes out from here, one lot at a time
+    async def _awriter(self, client_socket):
+        a = client_socket.sock
+        while client_socket in self.sockets:
+            await a.ev.wait()
+            try:
+                client_socket.st.tx += client_socket.buf.send(a)
+                a.ev.clear() # (send() set it again) anything queued while it drains sets it once more
+                await a.w.drain()
+            except Exception:
+                break
 
-        if seq in ['A', 'B']:  # Up or Down arrow
-            i = 1 if seq == 'A' else -1
-            
-            if seq == 'B' and self._hist_loc < 1:
-                return
-        
-            self._hist_loc += i
 
-            history_line = self.search_history(self._line[:self._cursor_pos], self._hist_loc)
-
-            #print(f"arrow {seq} line {self._hist_loc} h={history_line}")
-            
-            if history_line:
-                self.ins_command(history_line,mv=False)
-            else:
-                self._hist_loc -= i
-
-            #return self._line, 'up' if seq == 'A' else 'down', self._cursor_pos
-        elif seq == 'C':  # Right arrow
-            if self._cursor_pos < len(self._line):
-                self._cursor_pos += 1
-                print('\033[C', end='')
-        elif seq == 'D':  # Left arrow
-            if self._cursor_pos > 0:
-                self._cursor_pos -= 1
-                print('\033[D', end='')
-        elif seq == '3~':  # Delete
-            if self._cursor_pos < len(self._line):
-                self._line = self._line[:self._cursor_pos] + self._line[self._cursor_pos + 1:]
-                print('\033[1P', end='')  # Delete character at cursor position
-        elif seq == '2~':  # Insert
-            self._insert_mode = not self._insert_mode
-        elif seq in ['H', '1~']:  # Home
-            if self._cursor_pos > 0:
-                print(f'\033[{self._cursor_pos}D', end='')  # Move cursor left by current cursor_pos
-            self._cursor_pos = 0
-        elif seq in ['F', '4~']:  # End
-            d=len(self._line) - self._cursor_pos
-            if d>0:
-                print(f'\033[{d}C', end='')  # Move cursor right by difference
-            self._cursor_pos = len(self._line)
-        elif seq == '1;5D':  # Ctrl-Left
-            if self._cursor_pos > 0:
-                prev_pos = self._cursor_pos
-                while self._cursor_pos > 0 and self._line[self._cursor_pos - 1].isspace():
-                    self._cursor_pos -= 1
-                while self._cursor_pos > 0 and not self._line[self._cursor_pos - 1].isspace():
-                    self._cursor_pos -= 1
-                print(f'\033[{prev_pos - self._cursor_pos}D', end='')
-        elif seq == '1;5C':  # Ctrl-Right
-            if self._cursor_pos < len(self._line):
-                prev_pos = self._cursor_pos
-                while self._cursor_pos < len(self._line) and not self._line[self._cursor_pos].isspace():
-                    self._cursor_pos += 1
-                while self._cursor_pos < len(self._line) and self._line[self._cursor_pos].isspace():
-                    self._cursor_pos += 1
-                print(f'\033[{self._cursor_pos - prev_pos}C', end='')
-        elif seq.endswith('R'):  # Cursor position report
-            try:
-                self._TERM_HEIGHT, self._TERM_WIDTH = map(int, seq[:-1].split(';'))
-            except Exception as e:
-                import binascii
-                print("term-size set command {} error: {}; seq={}",format(seq[:-1],e,  binascii.hexlify(seq)  ))
-            return self._line, 'sz', self._cursor_pos
-        elif seq.startswith('>') and seq.endswith('c'):  # Extended device Attributes
-            self._TERM_TYPE_EX = seq[1:-1]
-            return seq, 'attr', self._cursor_pos
-        elif seq.startswith('?') and seq.endswith('c'):  # Device Attributes
-            self._TERM_TYPE = seq[1:-1]
-            return seq, 'attr', self._cursor_pos
-        return None
+    # The line editor lives in telnetd_edit.py, and is only loaded the first time it's used
+    def _editor(self):
+        if self._ed is None:
+            from telnetd_edit import LineEditor
+            self._ed = LineEditor(self)
+        return self._ed
 
+    def _read_nonblocking(self): # for STDIN only
+        return self._editor().read_nonblocking()
 
+    def _process_input(self, data):
+        return self._editor().process_input(data)
 
     def readline(self):
         #self.led.value(1)
@@ -336,193 +1005,487 @@ class telnetd(uio.IOBase):
         raise EOFError("No more input")
 
     def _del_old_socks(self,sockdel):
-        for i in sockdel:
-            client_socket=self.sockets[i]
-            client_socket['sock'].close()
-            p=f"Closed telnet client {i} IP {client_socket['addr']}"
-            del self.sockets[i]
+        for client_socket in sockdel:
+            if client_socket not in self.sockets:
+                continue # already gone (listed twice)
+            try:
+                self._poll.unregister(client_socket.sock)
+            except KeyError:
+                pass # never made it through the handshake
+            if client_socket.xf: # upload cut short; what's in name.part can be resumed
+                client_socket.xf.f.close()
+                client_socket.xf = None
+            client_socket.sock.close()
+            if self._log and not client_socket.state & _S_LOGIN:
+                self._log.rec('-', client_socket.id, '{}\n'.format(time.time()).encode())
+                self._log.flush()
+            p=f"Closed telnet client IP {client_socket.addr}"
+            if client_socket.state & _S_LOGIN:
+                self._nunauth -= 1
+            self.sockets.remove(client_socket)
+            del self._socks[client_socket.sock]
             self.print_console_message(p)
 
     def readinto(self, b):
         #self.led.value(1)
         #print("readinto b=", b)
-        self.read(0) # fill _nbuf
-        n = min(len(self._nbuf), len(b))
+        if self._cn:
+            self._due_out()
+        if not self._in.n: # dupterm asks for one byte at a time; only go to the sockets once what we have is used up
+            if self._lq:
+                k = self._in.put(self._lq)
+                self._lq = self._lq[k:] or None
+            elif not self.sockets: # nobody connected (most of a board's life): nothing to read, and a new connection arrives through accept_telnet_connect()'s socket callback
+                return None
+            elif not self._aserver: # in async mode the client coroutines fill _in
+                self.read_input()
+        n = self._in.get(b)
         if n == 0:
             return None
-        b[:n] = self._nbuf[:n].encode('utf-8')
-        self._nbuf = self._nbuf[n:]
+        if not self._in.n: # that was all of it: typing, not a paste. Let its echo bypass write()'s coalescing
+            if self._lm: # unless it was a whole line from a line-mode session: nobody's waiting on that echo, so let it coalesce into one send
+                self._lm = False
+            else:
+                self._echo_until = time.ticks_add(time.ticks_ms(), 10)
         return n
 
 
-
     def read(self, n): # not needed for dupterm
         #self.led.value(1)
         #print("read", n)
-        c=self.read_input()
-        if c is not None:
-            self._nbuf += c
-        if len(self._nbuf) >= n:
-            result = self._nbuf[:n]
-            self._nbuf = self._nbuf[n:]
-        else:
-            result = self._nbuf
-            self._nbuf = ""
-        return result.encode('utf-8')
+        if self.sockets and not self._aserver:
+            self.read_input()
+        b = bytearray(min(n, self._in.n))
+        self._in.get(b)
+        return bytes(b)
 
 
     def ioctl(self, op, arg):
         #self.led.value(1)
-        if op == 3 and self._nbuf:
+        if self._cn:
+            self._due_out()
+        if op == 3 and self._in.n:
             return const(0x0001)
         return 0
 
 
+    # Data from one client (either server mode), in buf[:n]: telnet commands, the password, or input for the REPL, which is queued in _in.
+    # Returns False if the client should be dropped
+    def _client_data(self, client_socket, buf, n):
+        st = client_socket.st
+        st.rx += n
+        st.last = time.ticks_ms()
+        if client_socket.state & _S_NEG:
+            client_socket.seen = True
+
+        #print("data: ", binascii.hexlify(buf[:n])) # data:  b'0d00'
+        k = self._iac(client_socket, buf, n) # telnet commands out; enter-key's 00 out
+        ok = True
+        if k and client_socket.ed and not client_socket.state & _S_LOGIN:
+            self._line_input(client_socket, bytes(buf[:k]))
+        elif k and not client_socket.state & _S_LOGIN:
+            self._repl_in(memoryview(buf)[:k])
+            if self._log:
+                self._log.rec('<', client_socket.id, memoryview(buf)[:k])
+        elif k:
+            ok = self._login(client_socket, bytes(buf[:k]).decode('utf-8', 'ignore'))
+        memoryview(buf)[:n] = memoryview(_BLANK)[:n] # blank it again for next time (see _iac)
+        return ok and not client_socket.state & _S_DROP
+
+    # Input for the REPL, in order: into _in, and whatever doesn't fit waits in _lq until readinto() has made room
+    def _repl_in(self, b):
+        if self._lq:
+            self._lq += bytes(b)
+        else:
+            k = self._in.put(b)
+            if k < len(b):
+                self._lq = bytes(b[k:])
+
+    # Input from a line-mode session: its editor echoes and redraws to this client alone, and only whole lines (or control keys the REPL
+    # has to see straight away, like ^C) go on to the REPL. The REPL echoes what it's given to everyone; the typist has seen it already
+    def _line_input(self, client_socket, data):
+        ed = client_socket.ed
+        try:
+            r = ed.process_input(data)
+            while r:
+                line, what = r[0], r[1]
+                if what == 'enter' or what == 'key':
+                    b = line.encode() + (b'\r' if what == 'enter' else b'')
+                    self._repl_in(b)
+                    self._lm = True
+                    if self._log:
+                        self._log.rec('<', client_socket.id, b)
+                    e = b[:-1] if what == 'key' else line.encode() + b'\r\n' # the REPL echoes Enter as CR LF, and doesn't echo control keys
+                    client_socket.ech = e if e else None
+                r = ed.process_input(b'')
+        except Exception: # read_input() would take anything raised here for a dead socket; an editor that trips up costs the line being typed, not the session
+            client_socket.ed = self._line_editor(client_socket)
+            self._queue(client_socket, b'\x07\r\n') # BEL, and a fresh line
+        self.send_chars_to_all(b'') # the redraw
+
+    def _line_editor(self, client_socket): # a line-mode session's editor, redrawing to that client alone
+        from telnetd_edit import LineEditor
+        return LineEditor(self, lambda s: self._queue(client_socket, s.encode()))
+
+    # Password typed by a client that hasn't logged in. Returns False if it got it wrong
+    def _login(self, client_socket, data):
+        client_socket.pw += data
+        if client_socket.pw and (ord(client_socket.pw[-1]) == 0x0d or len(client_socket.pw)>63): # caution; neither client_socket.pw[-1]=='\n' nor client_socket.pw.endswith('\n') work here!
+            client_socket.pw = client_socket.pw[:-1] # .rstrip('\n') does not work here
+            #if client_socket.pw == self.tspassword:
+            if self._chkpass('chk',client_socket.pw,self.tspassword):
+                import network
+                client_socket.state &= ~_S_LOGIN # this lets them in
+                if self._log:
+                    self._log.rec('+', client_socket.id, '{} {}\n'.format(time.time(), client_socket.addr).encode())
+                client_socket.pw = ''
+                if self.line_mode:
+                    client_socket.ed = self._line_editor(client_socket)
+                self._nunauth -= 1
+                if client_socket.addr[0] in self._fails:
+                    del self._fails[client_socket.addr[0]]
+                if client_socket.state & _S_NEG: # typed it before the handshake finished; skip the rest of it
+                    client_socket.state &= ~_S_NEG
+                    client_socket.st.neg_ms = time.ticks_diff(time.ticks_ms(), client_socket.st.t0)
+                #client_socket.sock.send()
+                client_socket.buf.put("\r\nWelcome to\x1b[32;1m {} \x1b[0m- {} Micropython {} on {} running\x1b[33;1m {} v{}\x1b[0m\r\n>>> ".format(network.WLAN(network.STA_IF).config('hostname'),uos.uname().sysname,uos.uname().version,uos.uname().machine,__file__,__version__).encode('utf-8'))
+                if self.compress is None:
+                    self.compress = _Deflate.available()
+                if self.compress:
+                    client_socket.buf.put(b'\xff\xfb\x56') # IAC WILL COMPRESS2
+                #print("",end='')
+                self.send_chars_to_all(b'')
+            else:
+                self._stats.auth_fail += 1
+                self._auth_failed(client_socket.addr[0])
+                try:
+                    client_socket.sock.send(b'wrong.\r\n')
+                except:
+                    pass
+                return False
+        return True
+
     # Read input from stdin, sockets, or files
     def read_input(self):
         #self.led.value(1)
-
-        chars=1 # keep doing this 'till we get nothing more
-        if chars:
-        #while chars:
-            chars=''
-            #chars = self._read_nonblocking() # Read from stdin
-
+        t0 = time.ticks_us()
+        outer = self._busy is None
+        if outer:
+            self._busy = time.ticks_ms()
+        try:
             # Read from sockets
             sockdel=[]
-            for i, client_socket in enumerate(self.sockets):
-                client_socket['r'], _, client_socket['e'] = select.select([client_socket['sock']], [], [client_socket['sock']], 0)
-                for s in client_socket['r']:
+            accept=False
+            buf = self._pool[0]
+            for ent in self._poll.ipoll(0): # only the sockets with something to say
+                s, ev = ent[0], ent[1] # ipoll() hands back a re-used tuple; don't keep it
+                if s is self.server_socket:
+                    accept = not ev & _PERR # accept after the loop, so we don't register sockets while ipoll() is iterating
+                    continue
+                client_socket = self._socks.get(s)
+                if client_socket is None:
+                    continue
+                if ev & _PERR:
+                    sockdel.append(client_socket) # remember to close it shortly
+                    continue
+                x = client_socket.xf
+                if x: # upload streaming in: straight from the socket into its block, none of the telnet or REPL handling
                     try:
-                        #data = client_socket['sock'].recv(1024).decode('utf-8').rstrip('\000')
-                        data = client_socket['sock'].recv(1024) #   OSError: [Errno 113] ECONNABORTED
-
-                        #if data:
-                        #    print("data: ", binascii.hexlify(data)) # data:  b'0d00'
-                        data = data.rstrip(b'\000') # enter-key has 00 added after it
-                        if data:
-                            try:
-                                data = data.decode('utf-8')
-                            except:
-                                data='?'
-
-                            if 'a' in client_socket: # not authenticated yet
-                                client_socket['a'] += data
-                                if ord(client_socket['a'][-1]) == 0x0d or len(client_socket['a'])>63: # caution; neither client_socket['a'][-1]=='\n' nor client_socket['a'].endswith('\n') work here!
-                                    client_socket['a'] = client_socket['a'][:-1] # .rstrip('\n') does not work here
-                                    #if client_socket['a'] == self.tspassword:
-                                    if self._chkpass('chk',client_socket['a'],self.tspassword):
-                                        import network
-                                        del client_socket['a'] # this lets them in
-                                        #client_socket['sock'].send()
-                                        client_socket['buf']="\r\nWelcome to\x1b[32;1m {} \x1b[0m- {} Micropython {} on {} running\x1b[33;1m {} v{}\x1b[0m\r\n>>> ".format(network.WLAN(network.STA_IF).config('hostname'),uos.uname().sysname,uos.uname().version,uos.uname().machine,__file__,__version__).encode('utf-8')
-                                        #print("",end='')
-                                        self.send_chars_to_all("")
-                                    else:
-                                        try:
-                                            client_socket['sock'].send(b'wrong.\r\n')
-                                        except:
-                                            pass
-                                        sockdel.insert(0,i) # kick off the attempt
-                            else:
-                                chars = chars + data if chars else data
-                        else:
-                            #print("EOF ", client_socket['addr'])
-                            sockdel.insert(0,i) # remember to close it shortly (backwards from end, so index numbers don't change in the middle)
-                    except Exception as e:
-                        #cannot print from inside a dupterm handler: print("read Exception ",e, "on ", client_socket['addr'])
-                        #self.print_console_message(f"read Exception {e} on {client_socket['addr']}")
-                        sockdel.insert(0,i) # remember to close it shortly (backwards from end, so index numbers don't change in the middle)
+                        n = s.readinto(x.mv[x.fill:], min(_XBLK - x.fill, x.left))
+                        if n is not None and (not n or not self._xfer_data(client_socket, n)):
+                            sockdel.append(client_socket)
+                    except Exception:
+                        sockdel.append(client_socket)
+                    continue
+                room = 0 if self._lq else self._in.size - self._in.n
+                if not room: # the REPL hasn't caught up; leave it in the socket (TCP will slow the sender) until it has
+                    continue
+                try:
+                    n = s.readinto(buf, min(room, len(buf))) #   OSError: [Errno 113] ECONNABORTED
+                    if n is None: # nothing after all
                         continue
-    
-                for s in client_socket['e']:
-                    #self.print_console_message(f"Handling exceptional condition for {client_socket['addr']}")
-                    if i not in sockdel:
-                        sockdel.insert(0,i) # remember to close it shortly (backwards from end, so index numbers don't change in the middle)
-    
-            self._del_old_socks(sockdel)
-    
-    
-            if self.server_socket:# Accept new connections
-                readable, _, exceptional = select.select([self.server_socket], [], [self.server_socket], 0)
-                for s in exceptional:
-                    #self.print_console_message("server_socket err?") # print("server_socket err?",s)
-                    pass
-                for s in readable:
-                    # Handle new connection
-                    self.accept_telnet_connect(None) # self.server_socket)
-
-        if chars:
-            return chars
+                    if not n:
+                        #print("EOF ", client_socket.addr)
+                        sockdel.append(client_socket) # remember to close it shortly
+                        continue
+                    if not self._client_data(client_socket, buf, n):
+                        sockdel.append(client_socket) # kick off the attempt
+                except Exception as e:
+                    #cannot print from inside a dupterm handler: print("read Exception ",e, "on ", client_socket.addr)
+                    #self.print_console_message(f"read Exception {e} on {client_socket.addr}")
+                    sockdel.append(client_socket) # remember to close it shortly
+
+            if self._nunauth: # advance connection handshakes (logins that take too long are _reap()'s job)
+                now = time.ticks_ms()
+                for client_socket in self.sockets:
+                    if client_socket.state & _S_NEG and not self._negotiate(client_socket, now):
+                        sockdel.append(client_socket)
 
-            if chars: # old code below
+            self._del_old_socks(sockdel)
 
-                for char in chars:
-                    response = self._process_input(char)
-                    if response:
-                        user_input, key, cursor = response
-                        if key=='enter':
-                            #if len(user_input):
-                            #    self.add_hist(user_input)
-                            return user_input
-                        elif key != 'sz': 
-                            oops=f" (mode {key} not implimented)";
-                            print(oops +  '\b' * (len(oops)), end='')
+            self._due_out()
 
-            elif time.ticks_ms()-self._lastread > 100:
-                time.sleep(0.1)  # Small delay to prevent high CPU usage
+            if accept: # Accept new connections
+                self.accept_telnet_connect(None) # self.server_socket)
 
-        return None
+            us = self._stats.read(t0)
+            if outer:
+                self._pass_end(us)
+            return None
+        finally:
+            if outer: # even when the pass raised: left set, every later pass would count as nested and the watchdog would go unfed
+                self._busy = None
 
+    # dupterm hands us output in tiny pieces (one char of echo, one line of print()). Collect it for up to coalesce_ms or len(_cbuf) bytes, so
+    # it goes out in a few full TCP segments instead of one per piece. Echo of what was just typed goes straight out
     def write(self, data):
-        self.send_chars_to_all(data.decode('utf-8'))
-        return(len(data))
-
-    # Send characters to all sockets and files. should be called often with '' for flushing slow sockets (until it says all-gone)
-    def send_chars_to_all(self, chars):
-        if chars:
-            chars = chars.replace('\r\n', '\n').replace('\n', '\r\n') # # Convert LF to CRLF (not breaking any existing ones)
-            #if isinstance(chars, bytes):
-            #    print("BAD");exit();#chars = chars.replace(b'\\n', b'\r\n')  # Convert LF to CRLF
-            #else:
-            #    chars = chars.replace('\\n', '\r\n')  # Convert LF to CRLF
-
-            #chars= binascii.hexlify(chars)
-
-
-            # Send to stdout
-            # sys.stdout.write(chars) # not in dupterm
-            # sys.stdout.flush() # AttributeError: 'FileIO' object has no attribute 'flush'
-
-        # Flag to check if any buffer has remaining data
-        any_buffer_non_empty = False
-
-        # Send to all sockets
-        sockdel=[]
-        for i, client_socket in enumerate(self.sockets):
-            if 'a' in client_socket:
-                continue # as-yet unauthenticated connection
-            client_socket['buf'] += chars.encode('utf-8')
-            if client_socket['buf']:
-                _, client_socket['w'], client_socket['e'] = select.select([], [client_socket['sock']], [client_socket['sock']], 0)
-                for s in client_socket['w']:
-                    try:
-                        bsent=client_socket['sock'].send(client_socket['buf'])
-                        client_socket['buf'] = client_socket['buf'][bsent:]  # Fix partial sends by updating the buffer
-                    except Exception as e:
-                        self.print_console_message('Telnet socket send exception: {}'.format(e)) # Socket send exception: {}
-                        sockdel.insert(0,i) # remember to close it shortly
-
-            if client_socket['buf']: # Update the flag if there is still data in the buffer
-                any_buffer_non_empty = True
-
-            if len(client_socket['buf']) > 80:
-                client_socket['buf'] = client_socket['buf'][-80:]  # Keep only the last 80 chars
-
-        self._del_old_socks(sockdel)
+        n = len(data)
+        if len(self.sockets) == self._nunauth: # no one logged in to see it: none of the CRLF, copying or coalescing
+            return n
+        now = time.ticks_ms()
+        if not self.coalesce_ms or n >= len(self._cbuf) or time.ticks_diff(self._echo_until, now) > 0:
+            self._coalesce_out() # keep the order
+            self.send_chars_to_all(bytes(data)) # dupterm lends us its buffer for the duration of this call only; one copy, shared by every client
+            return(n)
+        if self._cn + n > len(self._cbuf):
+            self._coalesce_out()
+        if not self._cn:
+            self._cdue = time.ticks_add(now, self.coalesce_ms)
+            self._arm_flush()
+        self._cbuf[self._cn:self._cn + n] = data
+        self._cn += n
+        if time.ticks_diff(now, self._cdue) >= 0:
+            self._coalesce_out()
+        return(n)
+
+    # Send whatever write() has been collecting
+    def _coalesce_out(self):
+        if self._cn:
+            data = bytes(self._cbuf[:self._cn])
+            self._cn = 0
+            self.send_chars_to_all(data)
+
+    # Collected output goes at its deadline. Mostly that's noticed here, from dupterm's polling (readinto(), ioctl()) and read_input()
+    def _due_out(self):
+        if self._cn and time.ticks_diff(time.ticks_ms(), self._cdue) >= 0:
+            self._coalesce_out()
+
+    # ... but a program that prints and then carries on without reading input doesn't poll, so a one-shot timer is set for the deadline too
+    def _arm_flush(self):
+        if self._sched or self.coalesce_timer is None:
+            return
+        try:
+            if self._tmr is None:
+                from machine import Timer
+                self._tmr = Timer(self.coalesce_timer)
+            self._tmr.init(mode=self._tmr.ONE_SHOT, period=max(1, time.ticks_diff(self._cdue, time.ticks_ms())), callback=self._tmr_cb)
+            self._sched = True
+        except Exception: # no such timer on this port: polling only
+            self.coalesce_timer = None
+
+    def _tmr_fire(self, tmr): # in the timer interrupt: the sending is done from the scheduler
+        try:
+            micropython.schedule(self._due_cb, None)
+        except RuntimeError: # schedule queue full; polling will get it
+            self._sched = False
+
+    def _flush_due(self, unused):
+        self._sched = False
+        if self._cn:
+            if self._busy is not None or time.ticks_diff(self._cdue, time.ticks_ms()) > 0: # a pass is running (we may be inside it), or it's early: go again
+                self._arm_flush()
+            else:
+                self._coalesce_out()
+
+    # Convert LF to CRLF (not breaking any existing ones) in a single pass, into a re-used scratch buffer. A CR at the end of the previous write still counts.
+    def _crlf(self, data):
+        i = data.find(b'\n')
+        if i < 0: # nothing to do (the common case for echo)
+            self._cr = data[-1] == 13
+            return data
+        need = len(data) + data.count(b'\n')
+        if len(self._xbuf) < need:
+            self._xbuf = bytearray(need + 64)
+        x = memoryview(self._xbuf)
+        d = memoryview(data) # slices of this don't copy
+        j = n = 0
+        while i >= 0:
+            x[n:n + i - j] = d[j:i]
+            n += i - j
+            if not (data[i - 1] == 13 if i else self._cr):
+                x[n] = 13 # \r
+                n += 1
+            x[n] = 10 # \n
+            n += 1
+            j = i + 1
+            i = data.find(b'\n', j)
+        x[n:n + len(data) - j] = d[j:]
+        n += len(data) - j
+        self._cr = data[-1] == 13
+        return x[:n]
+
+    # Send characters to all sockets and files. should be called often with b'' for flushing slow sockets (until it says all-gone)
+    def send_chars_to_all(self, data):
+        t0 = time.ticks_us()
+        outer = self._busy is None
+        if outer:
+            self._busy = time.ticks_ms()
+        try:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if data:
+                data = self._crlf(data) # once, for everyone
+                if self._log and len(self.sockets) > self._nunauth: # someone's logged in to see it
+                    self._log.rec('>', 0, data)
+
+            # Flag to check if any buffer has remaining data
+            any_buffer_non_empty = False
+            aio = self._aserver is not None # async mode: only queue it, and leave the writing to each client's _awriter()
+
+            # Send to all sockets
+            sockdel=[]
+            for client_socket in self.sockets:
+                if client_socket.state & _S_DROP: # (see _queue)
+                    sockdel.append(client_socket)
+                    continue
+                if client_socket.state & _S_LOGIN:
+                    continue # as-yet unauthenticated connection
+                r = client_socket.buf
+                st = client_socket.st
+                try: # non-blocking send; a full socket just raises EAGAIN, so there is no need to select() first
+                    if not aio:
+                        st.tx += r.send(client_socket.sock)
+                    out = data
+                    if client_socket.ech and data: # line mode: cut the REPL's echo of the typist's own line out of their copy
+                        out = self._cut_echo(client_socket, data)
+                    if client_socket.z and out: # its own compressed copy of the payload. Bytes can't be dropped from the middle of a compressed stream, so a
+                        # backed-up client (output already queued) loses the payload before it's compressed instead, and one whose socket and buffer can't
+                        # take the whole compressed payload is closed. With nothing queued it's always compressed: it may well go straight out
+                        if r.n and r.n + len(out) > self.obuf_hi and not self._obuf_overflow(client_socket, len(out)):
+                            if self.obuf_policy == 'close':
+                                sockdel.append(client_socket)
+                                continue
+                            st.drop += len(out)
+                            out = b''
+                        else:
+                            t1 = time.ticks_us()
+                            st.zin += len(out)
+                            out = client_socket.z.compress(out)
+                            self._stats.zip(t1)
+                    if out:
+                        off = 0 # how much of the shared payload this client has taken
+                        if not r.n and not aio: # nothing queued ahead of it: hand the payload straight to the socket
+                            try:
+                                off = client_socket.sock.send(out)
+                                st.tx += off
+                            except OSError as e:
+                                if e.args[0] != 11: # EAGAIN
+                                    raise
+                        k = len(out) - off
+                        if k:
+                            if client_socket.z and k > r.size - r.n: # what the socket didn't take won't fit, and none of it can be dropped
+                                sockdel.append(client_socket)
+                                continue
+                            if r.n + k > self.obuf_hi and not client_socket.z and not self._obuf_overflow(client_socket, k):
+                                sockdel.append(client_socket) # 'close' policy: too slow to keep up
+                                continue
+                            if k > r.size - r.n: # more than the whole buffer; keep the newest whole lines, as drop_lines() does, so an escape sequence isn't cut in half
+                                cut = len(out) - (r.size - r.n)
+                                i = bytes(out[cut:]).find(b'\n')
+                                cut = cut + i + 1 if i >= 0 else len(out) # no line boundary left; throw it all away
+                                st.drop += cut - off
+                                off = cut
+                            r.put(out[off:])
+                            if not aio:
+                                st.partial += 1 # couldn't take it all
+                except OSError as e:
+                    self.print_console_message('Telnet socket send exception: {}'.format(e)) # Socket send exception: {}
+                    sockdel.append(client_socket) # remember to close it shortly
+
+                if r.n and aio:
+                    client_socket.sock.ev.set()
+                elif r.n: # Update the flag if there is still data in the buffer
+                    any_buffer_non_empty = True
 
-        return any_buffer_non_empty
+            self._del_old_socks(sockdel)
 
+            us = self._stats.send(t0)
+            if outer:
+                self._pass_end(us)
+            return any_buffer_non_empty
+        finally:
+            if outer: # (see read_input)
+                self._busy = None
+
+
+    # The part of data that client_socket still expects as echo of its last line (see _line_input) comes off the front; returns the rest
+    def _cut_echo(self, client_socket, data):
+        e = client_socket.ech
+        k = 0
+        m = min(len(e), len(data))
+        while k < m and data[k] == e[k]:
+            k += 1
+        client_socket.ech = e[k:] if k == len(data) and k < len(e) else None # all of data was echo and there's more to come; otherwise that was it
+        return data[k:] if k else data
+
+    # A client's output buffer is above its high watermark: make room for k more bytes according to obuf_policy. Returns False if the client should be
+    # dropped, or for a compressing client, if the k bytes should be
+    def _obuf_overflow(self, client_socket, k):
+        r = client_socket.buf
+        if self.obuf_policy == 'close':
+            return False
+        if self.obuf_policy == 'block' and not self._aserver: # backpressure: hold up the REPL until this client drains to the low watermark (in async mode only
+            # _awriter() can drain it, and it can't run while we wait)
+            t = time.ticks_ms()
+            while r.n + k > self.obuf_lo and time.ticks_diff(time.ticks_ms(), t) < self.obuf_wait:
+                b = r.send(client_socket.sock)
+                client_socket.st.tx += b
+                if not b:
+                    time.sleep_ms(2)
+            if r.n + k <= self.obuf_hi:
+                return True
+        if client_socket.z:
+            return False # nothing can be cut out of a compressed stream; the caller drops the new payload instead
+        client_socket.st.drop += r.drop_lines(r.n + k - self.obuf_lo) # 'drop' (or 'block' gave up): oldest whole lines go
+        return True
+
+    # Runtime counters, for finding out which clients cause stalls. Builds a dict rather than printing (which would go back through dupterm)
+    def stats(self):
+        g = self._stats
+        now = time.ticks_ms()
+        clients = []
+        for client_socket in self.sockets:
+            st = client_socket.st
+            clients.append({
+                'addr': client_socket.addr,
+                'auth': not client_socket.state & _S_LOGIN,
+                'rx': st.rx,                             # bytes in
+                'tx': st.tx,                             # bytes out
+                'drop': st.drop,                         # bytes thrown away by the output buffer
+                'partial': st.partial,                   # writes it couldn't take all of at once
+                'queued': client_socket.buf.n,        # bytes waiting in its output buffer
+                'idle_ms': time.ticks_diff(now, st.last),
+                'neg_ms': st.neg_ms,                     # how long the handshake took
+                'zin': st.zin,                           # bytes before compression (tx is after), if it's compressing
+            })
+        return {
+            'accepts': g.accepts,
+            'rejects': g.rejects,                        # connections refused by _admit()
+            'full': g.full,                              # connections turned away at max_sessions
+            'evicted': g.evicted,                        # idle sessions closed to make room (evict_idle)
+            'auth_fail': g.auth_fail,
+            'read_input_n': g.read_n,
+            'read_input_us': g.read_s * 1000000 + g.read_us,
+            'send_n': g.send_n,
+            'send_us': g.send_s * 1000000 + g.send_us,
+            'zip_us': g.zip_s * 1000000 + g.zip_us,      # of send_us, time spent compressing
+            'loop_hist': list(g.hist),                   # poll/flush passes by duration: [0] under 1ms, [i] 2**(i-1) to 2**i ms
+            'stalls': g.stalls,                          # passes that took stall_ms or more
+            'stall_worst_ms': g.worst,
+            'loop_idle_ms': time.ticks_diff(now, self._tick) if self._busy is None else 0, # since the last pass finished
+            'wdt_skip': g.wdt_skip,                      # watchdog feeds held back because a pass was stuck
+            'clients': clients,
+        }
 
     def open_socket(self, address, port, timeout=10): # GPT
         try:
@@ -536,8 +1499,21 @@ class telnetd(uio.IOBase):
 
     # Method to flush buffers
     def flush(self):
-        while self.send_chars_to_all(""):
+        self._coalesce_out()
+        while self.send_chars_to_all(b''):
             pass # time.sleep(0.1)  # Prevent a tight loop
+        if self._log:
+            self._log.flush()
+
+    # Log everything the clients type and everything sent to them to path (None: stop logging). The file is rotated at size bytes, keeping
+    # keep old ones. Records are marked "\x1e<tag><session>\x1f", tag being < typed, > sent, + logged in (time and address follow), - disconnected
+    # (time follows); see tools/tnlog.py. Writes are blk bytes, on blk boundaries, except on flush() and disconnects
+    def transcript(self, path='/telnetd.log', size=65536, keep=1, blk=4096):
+        if self._log:
+            self._log.close()
+            self._log = None
+        if path:
+            self._log = _Transcript(self, path, size, keep, blk)
 
         
     # Test or create a shadow password
@@ -553,7 +1529,7 @@ class telnetd(uio.IOBase):
             hasher.update(stored_data[2].encode() + pwd.encode()) # Hash the input password with the stored salt
             return binascii.b2a_base64(hasher.digest()).decode().strip() == stored_data[3] # check it matched the current password
         else: # hash and return new password
-            salt = binascii.b2a_base64(os.urandom(32)).decode().strip()
+            salt = binascii.b2a_base64(uos.urandom(32)).decode().strip()
             hasher = uhashlib.sha256()
             hasher.update(salt.encode() + pwd.encode())
             return '$5${}${}$'.format(salt, binascii.b2a_base64(hasher.digest()).decode().strip())
@@ -563,12 +1539,12 @@ class telnetd(uio.IOBase):
         uos.dupterm(None)
         del sys.modules['telnetd']
         for client_socket in self.sockets:
-            client_socket['sock'].close()
+            client_socket.sock.close()
         self.server_socket.close()
         del sys.modules['telnetd']
 
 
-def start():
+def start(mode='poll'): # mode='async' to run on the application's asyncio event loop instead of dupterm/socket callbacks
 
     t=telnetd()
     p="$5$bl0zjwUtt8T2WLJBH5Vadl/Ix6X+cFdJr5td4a0B+n0=$1txXuyLLzAvAMM/jYSlpRScy3nSwvTQ05Mv7At5LiSs=$"  # linux shadow format. default password is: pass
@@ -579,13 +1555,12 @@ def start():
                 break
     except:
         pass
-    t.telnetd(p) # to use plaintext instead of encrypted passwords, use:   t.telnetd( t._chkpass('create','some plaintext password') )
+    t.telnetd(p, mode=mode) # to use plaintext instead of encrypted passwords, use:   t.telnetd( t._chkpass('create','some plaintext password') )
     # Create passwords with:  t._chkpass('create','my_new_password'); or run "import sh" then "passwd"
     uos.dupterm(t)
+    return t
 
 
-start()
-
 
 # import gc
 # gc.collect()
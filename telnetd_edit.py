@@ -0,0 +1,369 @@
+# telnetd_edit.py
+
+# Line editor for telnetd (cursor keys, insert/delete, history), split out so that telnetd doesn't
+# carry it in RAM unless something uses it. telnetd loads it the first time it's needed: for the
+# local console, or one per session in line mode (telnetd.line_mode).
+#
+# Created by Chris Drake.
+# Full-featured telnet daemon for micropython  https://github.com/gitcnd/telnetd
+
+import sys
+import time
+import select
+
+
+# What each input byte is to the editor: 0 is text (inserted, a run at a time), anything else indexes LineEditor._ACT
+_K_TEXT, _K_IGNORE, _K_ENTER, _K_BS, _K_ESC, _K_INTR, _K_EXIT = 0, 1, 2, 3, 4, 5, 6
+_KEYS = bytearray(256)
+_KEYS[0:32] = bytes((_K_IGNORE,)) * 32
+_KEYS[13] = _KEYS[10] = _K_ENTER
+_KEYS[8] = _KEYS[127] = _K_BS
+_KEYS[27] = _K_ESC
+_KEYS[3] = _K_INTR  # ctrl-C
+_KEYS[1] = _K_EXIT  # ctrl-A: repl exit
+
+# Decoder states
+_D_TEXT, _D_ESC, _D_CSI = 0, 1, 2
+
+
+def _ncols(b, a, z): # characters (terminal columns) in b[a:z]: UTF-8 continuation bytes don't count
+    k = 0
+    for i in range(a, z):
+        if b[i] & 0xc0 != 0x80:
+            k += 1
+    return k
+
+
+class LineEditor:
+
+    def __init__(self, t, out=None):
+        self.t = t # the telnetd, for the terminal size and type
+        self._out = out     # where redraws go: a function taking a str (a session's own output, in line mode), or None for print()
+        self._nbuf = ""
+        self._b = bytearray(256)  # the line being edited, in place, as UTF-8; _n bytes of it are used (grows if a line is longer). The cursor only
+                                  # ever sits at the start of a character, and moves and deletes go by whole characters
+        self._n = 0
+        self._cursor_pos = 0
+        self._lastread = time.ticks_ms()
+        self._st = _D_TEXT
+        self._esc_seq = ""  # an escape sequence's parameters so far, after the ESC [ or ESC O
+        self._pend = None   # what's left of a chunk after an Enter (see process_input), or a character whose other bytes haven't arrived yet
+        self._o = []        # redraw output for this chunk, written in one go at the end of it
+        self._insert_mode = True  # Default to insert mode
+        self._hist_loc = -1  # Start with the most recent command (has 1 added before use; 0 means last)
+        self._hist = []      # lines entered, oldest first; up to t.line_hist of them
+        self._c = 0          # the last control byte dispatched (0 after text), so an LF straight after a CR isn't a second Enter
+
+    @property
+    def _line(self):
+        return self._b[:self._n].decode('utf-8', 'ignore')
+
+    def read_nonblocking(self): # for STDIN only
+        if select.select([sys.stdin], [], [], 0)[0]:
+            self._nbuf += sys.stdin.read(1)
+            #self._nbuf += sys.stdin.read() # hangs
+            #print(f" got={self._nbuf} ") # cnd
+
+            i = self._nbuf.find('\n') + 1
+            if i < 1: i = None
+            ret = self._nbuf[:i]
+            self._nbuf = self._nbuf[len(ret):]
+            return ret
+        return None
+
+
+    # Takes whatever arrived - one keystroke or a whole pasted chunk, str or bytes - and returns at the first thing the caller
+    # has to act on, as (line, what, cursor_pos); the rest of the chunk is kept, so call it again with '' until it returns None.
+    def process_input(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        now = time.ticks_ms()
+        if self._st:
+            if time.ticks_diff(now, self._lastread) > 100: # a lone ESC, or a sequence that never finished
+                self._st = _D_TEXT
+                self._esc_seq = ""
+                self._pend = (self._pend or b'') + data
+                return self._line, "esc", self._cursor_pos
+        elif len(data) == 1 and 32 <= data[0] < 127 and self._cursor_pos == self._n < len(self._b) and not self._pend:
+            self._lastread = now # one key typed at the end of the line: the usual case, straight through
+            self._b[self._n] = data[0]
+            self._n = self._cursor_pos = self._n + 1
+            self._c = 0
+            self._emit(chr(data[0]))
+            return None
+        self._lastread = now
+        if self._pend:
+            data = self._pend + data
+            self._pend = None
+        keys = _KEYS
+        act = self._ACT
+        n = len(data)
+        i = 0
+        ret = None
+        try:
+            while i < n:
+                c = data[i]
+                if self._st:
+                    i += 1
+                    ret = self._esc(c)
+                elif keys[c]:
+                    i += 1
+                    prev = self._c
+                    self._c = c
+                    ret = act[keys[c]](self, prev)
+                else:
+                    j = i + 1
+                    while j < n and not keys[data[j]]:
+                        j += 1
+                    self._text(data, i, j)
+                    i = j
+                if ret:
+                    if i < n:
+                        self._pend = data[i:]
+                    return ret
+        finally:
+            if self._o:
+                self._emit(''.join(self._o))
+                self._o = []
+        return None
+
+    def _emit(self, s):
+        if self._out:
+            self._out(s)
+        else:
+            print(s, end='')
+
+    def _text(self, data, i, j): # a run of plain characters, typed or pasted
+        self._c = 0
+        if j == len(data): # a UTF-8 character cut in two by the end of the chunk waits for the rest of it
+            q = j - 1
+            while q > i and q > j - 4 and data[q] & 0xc0 == 0x80:
+                q -= 1
+            if data[q] >= 0xc0 and j - q < (2 if data[q] < 0xe0 else 3 if data[q] < 0xf0 else 4):
+                self._pend = data[q:j]
+                j = q
+            if j == i:
+                return
+        s = data[i:j]
+        c = len(s) if max(s) < 0x80 else _ncols(s, 0, len(s)) # (plain ASCII, nearly always: no need to count)
+        p = e = self._cursor_pos
+        if self._insert_mode:
+            if p < self._n:
+                self._o.append('\033[{}@'.format(c))  # make room for them at the cursor
+        else: # typing over as many characters as there are
+            for _ in range(c):
+                if e < self._n:
+                    e = self._next(e)
+        self._splice(p, e, s)
+        self._o.append(s.decode('utf-8', 'ignore'))
+        self._cursor_pos = p + len(s)
+
+    def _splice(self, p, e, s): # replace _b[p:e] with s, moving the rest of the line up or down to fit
+        b = self._b
+        n = self._n
+        d = len(s) - (e - p)
+        if n + d > len(b):
+            b.extend(bytes(n + d))
+        if d and e < n:
+            b[e + d:n + d] = b[e:n]
+        b[p:p + len(s)] = s
+        self._n = n + d
+
+    def _prev(self, p): # where the character before byte p starts
+        p -= 1
+        while p > 0 and self._b[p] & 0xc0 == 0x80:
+            p -= 1
+        return p
+
+    def _next(self, p): # where the character after the one at byte p starts
+        p += 1
+        while p < self._n and self._b[p] & 0xc0 == 0x80:
+            p += 1
+        return p
+
+    # Control keys. In line mode the ones the editor has no use for (Tab, ^D, ^E...) go to the REPL as they are, with whatever's been
+    # typed on the line so far ahead of them, as ('<line><key>', 'key', 0); ^C goes alone and the line is thrown away
+
+    def _k_ignore(self, prev):
+        if self._out:
+            ret_line = self._line + chr(self._c)
+            self._clear()
+            return ret_line, 'key', 0
+        return None
+
+    def _k_enter(self, prev):
+        if self._c == 10 and prev == 13: # CR LF is one Enter
+            return None
+        self._o.append('\r\n')
+        ret_line = self._line
+        if ret_line.strip() and (not self._hist or self._hist[-1] != ret_line):
+            self._hist.append(ret_line)
+            if len(self._hist) > self.t.line_hist:
+                self._hist.pop(0)
+        self._clear()
+        return ret_line, 'enter', self._cursor_pos
+
+    def _clear(self):
+        self._n = 0
+        self._cursor_pos = 0
+        self._hist_loc = -1
+
+    def _k_bs(self, prev):
+        if self._cursor_pos > 0:
+            p = self._prev(self._cursor_pos)
+            self._splice(p, self._cursor_pos, b'')
+            self._cursor_pos = p
+            self._o.append('\b\033[1P')
+        return None
+
+    def _k_esc(self, prev):
+        self._st = _D_ESC
+        return None
+
+    def _k_intr(self, prev):
+        if self._out:
+            self._clear()
+            return '\x03', 'key', 0
+        self._o.append("KeyboardInterrupt:\r\n")
+        raise KeyboardInterrupt
+
+    def _k_exit(self, prev):
+        if self._out:
+            return self._k_ignore(prev)
+        return 'exit', 'enter', 0
+
+    _ACT = (None, _k_ignore, _k_enter, _k_bs, _k_esc, _k_intr, _k_exit)
+
+    def _esc(self, c): # one byte of an escape sequence
+        if self._st == _D_ESC:
+            if c in (0x5b, 0x4f): # ESC [ or ESC O
+                self._st = _D_CSI
+                return None
+            self._st = _D_TEXT # not one we know: drop it
+            return None
+        if 0x20 <= c < 0x40: # parameters
+            self._esc_seq += chr(c)
+            if len(self._esc_seq) < 32:
+                return None
+            c = 0 # too long to be anything real
+        seq = self._esc_seq + chr(c)
+        self._st = _D_TEXT
+        self._esc_seq = ""
+        f = self._SEQ.get(seq)
+        if f:
+            return f(self)
+        if c == 0x52: # R: cursor position report
+            try:
+                self.t._TERM_HEIGHT, self.t._TERM_WIDTH = map(int, seq[:-1].split(';'))
+            except Exception as e:
+                import binascii
+                self._o.append("term-size set command {} error: {}; seq={}\r\n".format(seq[:-1], e, binascii.hexlify(seq.encode())))
+            return self._line, 'sz', self._cursor_pos
+        if c == 0x63 and seq[:1] == '>':  # Extended device Attributes
+            self.t._TERM_TYPE_EX = seq[1:-1]
+            return seq, 'attr', self._cursor_pos
+        if c == 0x63 and seq[:1] == '?':  # Device Attributes
+            self.t._TERM_TYPE = seq[1:-1]
+            return seq, 'attr', self._cursor_pos
+        return None
+
+    def _history(self, i): # Up (1) or Down (-1) arrow
+        if i < 0 and self._hist_loc < 1:
+            return None
+        self._hist_loc += i
+        history_line = self.search_history(self._b[:self._cursor_pos].decode('utf-8', 'ignore'), self._hist_loc)
+        if history_line:
+            self.ins_command(history_line,mv=False)
+        else:
+            self._hist_loc -= i
+        return None
+
+    def search_history(self, pfx, n): # the n'th most recent line (0: the last one) that starts with pfx, or None
+        for i in range(len(self._hist) - 1, -1, -1):
+            if self._hist[i].startswith(pfx):
+                if not n:
+                    return self._hist[i]
+                n -= 1
+        return None
+
+    def ins_command(self, line, mv=True): # replace the line being edited with line, leaving the cursor at its end (mv) or where it was
+        p = self._cursor_pos
+        if p:
+            self._o.append('\033[{}D'.format(_ncols(self._b, 0, p)))
+        e = line.encode()
+        m = len(e)
+        self._splice(0, self._n, e)
+        self._o.append(line)
+        self._o.append('\033[K') # clear what's left of the old line
+        p = m if mv else min(p, m)
+        while 0 < p < m and self._b[p] & 0xc0 == 0x80: # (on a character boundary)
+            p -= 1
+        self._cursor_pos = p
+        if p < m:
+            self._o.append('\033[{}D'.format(_ncols(self._b, p, m)))
+
+    def _up(self):
+        return self._history(1)
+
+    def _down(self):
+        return self._history(-1)
+
+    def _right(self):
+        if self._cursor_pos < self._n:
+            self._cursor_pos = self._next(self._cursor_pos)
+            self._o.append('\033[C')
+
+    def _left(self):
+        if self._cursor_pos > 0:
+            self._cursor_pos = self._prev(self._cursor_pos)
+            self._o.append('\033[D')
+
+    def _delete(self):
+        p = self._cursor_pos
+        if p < self._n:
+            self._splice(p, self._next(p), b'')
+            self._o.append('\033[1P')  # Delete character at cursor position
+
+    def _insert(self):
+        self._insert_mode = not self._insert_mode
+
+    def _home(self):
+        if self._cursor_pos > 0:
+            self._o.append('\033[{}D'.format(_ncols(self._b, 0, self._cursor_pos)))  # Move cursor left to the start
+        self._cursor_pos = 0
+
+    def _end(self):
+        d = _ncols(self._b, self._cursor_pos, self._n)
+        if d > 0:
+            self._o.append('\033[{}C'.format(d))  # Move cursor right by difference
+        self._cursor_pos = self._n
+
+    def _word_left(self): # Ctrl-Left
+        b = self._b
+        p = q = self._cursor_pos
+        while p > 0 and b[p - 1] == 0x20:
+            p -= 1
+        while p > 0 and b[p - 1] != 0x20:
+            p -= 1
+        if p < q:
+            self._o.append('\033[{}D'.format(_ncols(b, p, q)))
+        self._cursor_pos = p
+
+    def _word_right(self): # Ctrl-Right
+        b = self._b
+        p = q = self._cursor_pos
+        while p < self._n and b[p] != 0x20:
+            p += 1
+        while p < self._n and b[p] == 0x20:
+            p += 1
+        if p > q:
+            self._o.append('\033[{}C'.format(_ncols(b, q, p)))
+        self._cursor_pos = p
+
+    # Escape sequences by what follows the ESC [ (or ESC O); cursor reports and device attributes are matched on their last byte
+    _SEQ = {
+        'A': _up, 'B': _down, 'C': _right, 'D': _left,
+        'H': _home, '1~': _home, '7~': _home, 'F': _end, '4~': _end, '8~': _end,
+        '2~': _insert, '3~': _delete,
+        '1;5D': _word_left, '1;5C': _word_right,
+    }
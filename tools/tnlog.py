@@ -0,0 +1,48 @@
+# tnlog.py
+
+# Print a telnetd transcript (see telnetd.transcript()) readably: who typed what, and what was sent back.
+#
+#   python3 tools/tnlog.py telnetd.log [telnetd.log.1 ...]     # oldest last, as rotated; printed oldest first
+#   python3 tools/tnlog.py --raw telnetd.log                   # just the output, as the terminals saw it
+
+import re
+import sys
+
+REC = re.compile(rb'\x1e([<>+-])(\d+)\x1f')
+
+
+def show(data, raw=False):
+    out = sys.stdout.buffer
+    parts = REC.split(data)
+    out.write(b'' if raw else parts[0])
+    for i in range(1, len(parts), 3):
+        tag, sid, body = parts[i], parts[i + 1], parts[i + 2]
+        if raw:
+            if tag == b'>':
+                out.write(body)
+        elif tag == b'+':
+            out.write(b'\n=== session ' + sid + b' logged in at ' + body)
+        elif tag == b'-':
+            out.write(b'\n=== session ' + sid + b' closed at ' + body)
+        elif tag == b'<':
+            out.write(b'\x1b[33m' + body.replace(b'\r', b'\\r') + b'\x1b[0m' if out.isatty() else b'[' + sid + b'< ' + body + b']')
+        else:
+            out.write(body)
+
+
+def main(argv):
+    raw = '--raw' in argv
+    files = [a for a in argv if a != '--raw']
+    if not files:
+        print('usage: tnlog.py [--raw] telnetd.log [telnetd.log.1 ...]')
+        return 2
+    data = b''
+    for name in reversed(files):
+        with open(name, 'rb') as f:
+            data += f.read()
+    show(data, raw)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,150 @@
+# tnput.py
+
+# Upload files to a board running telnetd, over telnetd's binary transfer option instead of pasting
+# them through the REPL.  Each file is streamed raw into flash, checked with crc32, and only then put
+# in place; an upload that gets cut off is resumed from where it stopped the next time it's run.
+#
+#   python3 tools/tnput.py [-p port] [-P password] host file[:remote] ...
+#
+# Remote names default to /<file name>.  The password can also come from $TELNETD_PASSWORD.
+
+import os
+import sys
+import time
+import zlib
+import socket
+import struct
+
+XFER = 201  # telnetd's _XFER option
+IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+MAXNAME = 66  # what's left of telnetd's 80-byte subnegotiation buffer after the request header
+ERRORS = {1: 'another upload is running', 2: 'resume offset mismatch', 3: 'file error on the board', 4: 'checksum mismatch', 5: 'bad remote name'}
+
+
+class Telnet:
+    """Just enough of a telnet client: refuses every option but ours, and collects text and our subnegotiation replies."""
+    def __init__(self, host, port, timeout=30):
+        self.s = socket.create_connection((host, port), timeout)
+        self.text = b''
+        self.replies = []
+        self.agreed = None
+        self._st = 0
+        self._verb = 0
+        self._sb = b''
+
+    def _feed(self, data):
+        for c in data:
+            if self._st == 0:
+                if c == IAC:
+                    self._st = 1
+                else:
+                    self.text += bytes((c,))
+            elif self._st == 1:
+                self._st = 0
+                if c >= WILL:
+                    self._verb = c
+                    self._st = 2
+                elif c == SB:
+                    self._sb = b''
+                    self._st = 3
+                elif c == IAC:
+                    self.text += b'\xff'
+            elif self._st == 2:
+                self._st = 0
+                if c == XFER:
+                    self.agreed = self._verb == DO
+                elif self._verb in (DO, WILL):
+                    self.s.sendall(bytes((IAC, WONT if self._verb == DO else DONT, c)))
+            elif self._st == 3:
+                if c == IAC:
+                    self._st = 4
+                else:
+                    self._sb += bytes((c,))
+            else:
+                self._st = 3
+                if c == SE:
+                    self._st = 0
+                    if self._sb[:1] == bytes((XFER,)):
+                        self.replies.append(self._sb[1:])
+                else:
+                    self._sb += bytes((c,))
+
+    def pump(self):
+        d = self.s.recv(65536)
+        if not d:
+            raise ConnectionError('connection closed; got {!r}'.format(self.text[-200:]))
+        self._feed(d)
+
+    def wait_text(self, want):
+        while want not in self.text:
+            self.pump()
+            if b'wrong.' in self.text:
+                raise PermissionError('wrong password')
+        self.text = self.text[self.text.index(want) + len(want):]
+
+    def request(self, cmd, payload):
+        self.s.sendall(bytes((IAC, SB, XFER, cmd)) + payload.replace(b'\xff', b'\xff\xff') + bytes((IAC, SE)))
+
+    def reply(self):
+        while not self.replies:
+            self.pump()
+        r = self.replies.pop(0)
+        vals = struct.unpack('>' + 'I' * ((len(r) - 1) // 4), r[1:])
+        if r[0] == 6:
+            raise IOError(ERRORS.get(vals[0], 'error {}'.format(vals[0])))
+        return r[0], vals
+
+
+def login(host, port, password):
+    t = Telnet(host, port)
+    t.wait_text(b'Password: ')
+    t.s.sendall(password.encode() + b'\r\0')
+    t.wait_text(b'>>> ')
+    t.s.sendall(bytes((IAC, WILL, XFER)))
+    while t.agreed is None:
+        t.pump()
+    if not t.agreed:
+        raise IOError('this telnetd does not support uploads')
+    return t
+
+
+def put(t, local, remote):
+    with open(local, 'rb') as f:
+        data = f.read()
+    name = remote.encode()
+    if len(name) > MAXNAME:
+        raise ValueError('remote name {} is {} bytes; telnetd takes at most {}'.format(remote, len(name), MAXNAME))
+    t.request(1, name)
+    code, (have, crc) = t.reply()
+    off = have if 0 < have <= len(data) and zlib.crc32(data[:have]) == crc else 0
+    t.request(2, struct.pack('>III', off, len(data), zlib.crc32(data)) + name)
+    t.reply() # 4: go ahead
+    t0 = time.time()
+    t.s.sendall(data[off:])
+    code, (crc,) = t.reply() # 5: stored
+    dt = max(time.time() - t0, 1e-6)
+    print('{} -> {}: {} bytes{} in {:.2f}s ({:.1f} kB/s)'.format(local, remote, len(data) - off, ' (resumed at {})'.format(off) if off else '', dt, (len(data) - off) / dt / 1024))
+
+
+def main(argv):
+    port = 23
+    password = os.environ.get('TELNETD_PASSWORD', 'pass')
+    while argv and argv[0] in ('-p', '-P'):
+        if argv[0] == '-p':
+            port = int(argv[1])
+        else:
+            password = argv[1]
+        argv = argv[2:]
+    if len(argv) < 2:
+        print('usage: tnput.py [-p port] [-P password] host file[:remote] ...')
+        return 2
+    t = login(argv[0], port, password)
+    for a in argv[1:]:
+        local, _, remote = a.partition(':')
+        put(t, local, remote or '/' + os.path.basename(local))
+    t.s.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))